@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""In-process stand-in for a DHIS2 server with just enough of the Web API for the hnqis-* commands"""
+
+import json
+import re
+import threading
+import time
+from datetime import datetime
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from src.indicator_healtharea_updater import HEALTH_AREAS
+from src.scan_event_mismatches import ORDER_FORWARD, OVERALL_SCORE
+from src.user_message import USER_MESSAGE_UID
+
+PREFIX = '/.hnqis.org'
+ATTRIBUTE_UID = 'pt5Ll9bb2oP'
+ROOT_COMPSCORE = 'Ex8EkRmuOJX'
+LAST_UPDATED = '2018-05-01T00:00:00.000'
+
+# columns of an /api/events/query grid before the data element columns
+GRID_COLUMNS = ('event', 'program', 'programStage', 'eventDate', 'lastUpdated', 'orgUnit', 'status')
+
+# the filter the commands use for usernames resolves to the user's own credentials
+FILTER_ALIASES = {
+    'userCredentials.userInfo.userCredentials.username': 'userCredentials.username'
+}
+
+
+def uid(prefix, i):
+    """Deterministic UID, e.g. uid('O', 12) -> 'O0000000012'"""
+    return '{}{:010d}'.format(prefix, i)
+
+
+def resolve(obj, path):
+    for key in FILTER_ALIASES.get(path, path).split('.'):
+        obj = (obj or {}).get(key)
+    return obj
+
+
+def matches(obj, dhis2_filter):
+    """Evaluate a DHIS2 metadata filter like `id:in:[a,b]` or `name:!ilike:_DEL` against an object"""
+    path, operator, value = dhis2_filter.split(':', 2)
+    actual = resolve(obj, path)
+    if operator == 'in':
+        return actual in value.strip('[]').split(',')
+    actual = u"{}".format(actual or '')
+    if operator == 'eq':
+        return actual == value
+    if operator.lstrip('!') in ('ilike', 'like$', 'like'):
+        if operator.lstrip('!') == 'like$':
+            found = actual.endswith(value)
+        elif operator.lstrip('!') == 'ilike':
+            found = value.lower() in actual.lower()
+        else:
+            found = value in actual
+        return found != operator.startswith('!')
+    raise ValueError(u"Filter operator not supported: {}".format(dhis2_filter))
+
+
+def select(obj, fields):
+    """Keep only the listed top-level fields of an object - nested field lists are kept whole.
+    The list itself may be bracketed, e.g. `[id,name]`"""
+    if not fields or ':' in fields:
+        return obj
+    if fields.startswith('[') and fields.endswith(']'):
+        fields = fields[1:-1]
+    names = set(re.sub(r'\[[^]]*\]', '', fields).split(','))
+    return {k: v for k, v in obj.items() if k in names}
+
+
+def generate(programs=10, orgunits=1000, users=1000, events=1000, mismatch_every=10, extra_values=0):
+    """Metadata and `events` events per program of a HNQIS instance.
+    Every event gets `extra_values` data values of other questions besides the scores."""
+    data = {
+        'organisationUnits': [{'id': uid('O', i), 'name': u"OrgUnit {}".format(i), 'attributeValues': []}
+                              for i in range(orgunits)],
+        'users': [{'id': uid('U', i), 'userCredentials': {'username': u"user{}".format(i)}, 'attributeValues': [],
+                   'userGroups': []} for i in range(users)],
+        'attributes': [{'id': attribute, 'name': name, 'organisationUnitAttribute': True, 'userAttribute': True}
+                       for attribute, name in ((ATTRIBUTE_UID, u"Attribute"), (USER_MESSAGE_UID, u"Message"))],
+        'dataElements': [{'id': ROOT_COMPSCORE, 'name': u"0CS-100", 'shortName': u"HNQIS.0CS-100"}],
+        'programs': [],
+        'programIndicators': [],
+        'indicators': []
+    }
+    for i in range(programs):
+        ha = HEALTH_AREAS[i % len(HEALTH_AREAS)]
+        name = u"HNQIS - {} {}".format(ha, i)
+        data['programs'].append({'id': uid('P', i), 'name': name, 'shortName': u"PSI HNQIS {} {}".format(ha, i),
+                                 'organisationUnits': []})
+        count = u"HNQIS - {} {} count".format(ha, i) if ha == 'VMMC' else u"HNQIS - {} count {}".format(ha, i)
+        data['programIndicators'].append({'id': uid('I', i), 'name': count, 'program': {'name': name}})
+    for i, ha in enumerate(HEALTH_AREAS):
+        data['indicators'].append({'id': uid('H', i), 'name': u"HNQIS - {} count".format(ha), 'numerator': ''})
+
+    data['events'] = []
+    for p, program in enumerate(data['programs']):
+        for i in range(events):
+            score = 80 if i % mismatch_every else 70
+            data['events'].append({
+                'event': uid('E', p * events + i),
+                'program': program['id'],
+                'orgUnit': uid('O', i % max(1, orgunits)),
+                'eventDate': '2018-04-{:02d}T00:00:00.000'.format(i % 28 + 1),
+                'lastUpdated': LAST_UPDATED,
+                'status': 'COMPLETED',
+                'dataValues': [
+                    {'dataElement': OVERALL_SCORE, 'value': str(score)},
+                    {'dataElement': ROOT_COMPSCORE, 'value': '80'},
+                    {'dataElement': ORDER_FORWARD, 'value': '1'}
+                ] + [{'dataElement': uid('D', j), 'value': str(j % 5)} for j in range(extra_values)]
+            })
+    return data
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeDhis2(object):
+    """DHIS2 stand-in serving the generated dataset on http://127.0.0.1:<port>/.hnqis.org (the suffix passes
+    the *.hnqis.org check of some commands). Every request is delayed by `latency` seconds.
+
+        server = FakeDhis2(latency=0.05, events=5000).start()
+        api = Client(server.url, 'admin', 'district')
+        ...
+        server.stop()
+    """
+
+    def __init__(self, latency=0.0, version='2.31.0', port=0, **size):
+        self.latency = latency
+        self.version = version
+        self.data = generate(**size)
+        self.index = {(name, o.get('id', o.get('event'))): o for name, objects in self.data.items() for o in objects}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}{}'.format(self._server.server_address[1], PREFIX)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, method, path, params, body):
+        """Return (status, payload) of a request to /api/<path>"""
+        path = re.sub(r'\.json$', '', path)
+        parts = path.split('/')
+        collection = parts[0]
+        if path == 'system/info':
+            return 200, {'version': self.version, 'revision': 'fake', 'serverDate': datetime.now().isoformat()}
+        if method == 'POST' and path == 'metadata':
+            return 200, self.import_metadata(body)
+        if collection == 'events':
+            return self.events(method, parts, params, body)
+        if collection not in self.data:
+            return 404, {'httpStatusCode': 404, 'message': u"Not found: {}".format(path)}
+        if len(parts) == 1 and method == 'GET':
+            return 200, self.query(collection, params)
+        obj = self.index.get((collection, parts[1]))
+        if obj is None:
+            return 404, {'httpStatusCode': 404, 'message': u"{} {} not found".format(collection, parts[1])}
+        if len(parts) == 3 and parts[2] == 'organisationUnits':
+            ids = set(o['id'] for o in body['identifiableObjects'])
+            current = [ou for ou in obj['organisationUnits'] if ou['id'] not in ids]
+            if method == 'POST':
+                current.extend({'id': i} for i in sorted(ids))
+            obj['organisationUnits'] = current
+            return 204, None
+        if method == 'GET':
+            return 200, select(obj, params.get('fields', [''])[0])
+        if method == 'PUT':
+            obj.update(body)
+            return 200, {'status': 'OK'}
+        if method == 'PATCH':
+            if int(self.version.split('.')[1]) < 37:
+                return 415, {'httpStatusCode': 415, 'message': u"JSON Patch is supported from 2.37"}
+            for operation in body:
+                obj[operation['path'].lstrip('/')] = operation['value']
+            return 200, {'status': 'OK'}
+        return 405, {'httpStatusCode': 405}
+
+    def query(self, collection, params):
+        objects = self.data[collection]
+        for dhis2_filter in params.get('filter', []):
+            objects = [o for o in objects if matches(o, dhis2_filter)]
+        fields = params.get('fields', [''])[0]
+        return self.page(collection, [select(o, fields) for o in objects], params)
+
+    @staticmethod
+    def page(collection, objects, params):
+        # requests sends booleans as True/False
+        if params.get('paging', ['true'])[0].lower() == 'false' or params.get('skipPaging', [''])[0].lower() == 'true':
+            return {collection: objects}
+        page_size = int(params.get('pageSize', [50])[0])
+        page = int(params.get('page', [1])[0])
+        total = len(objects)
+        return {
+            'pager': {'page': page, 'pageSize': page_size, 'total': total,
+                      'pageCount': max(1, -(-total // page_size))},
+            collection: objects[(page - 1) * page_size:page * page_size]
+        }
+
+    def events(self, method, parts, params, body):
+        if method == 'GET':
+            if 'event' in params:
+                uids = params['event'][0].split(';')
+                events = [self.index[('events', u)] for u in uids if ('events', u) in self.index]
+            else:
+                program = params['program'][0]
+                since = params.get('lastUpdatedStartDate', [''])[0]
+                events = [e for e in self.data['events'] if e['program'] == program and e['lastUpdated'] >= since]
+            if parts[1:] == ['query']:
+                return 200, self.grid(events, params)
+            return 200, self.page('events', events, params)
+        if method == 'POST':
+            for event in body['events']:
+                self.update_event(event)
+            return 200, {'responseType': 'ImportSummaries', 'status': 'SUCCESS', 'importSummaries': [
+                {'status': 'SUCCESS', 'reference': e['event']} for e in body['events']]}
+        if method == 'PUT':
+            self.update_event(body)
+            return 200, {'status': 'OK'}
+        return 405, {'httpStatusCode': 405}
+
+    def grid(self, events, params):
+        """/api/events/query: a grid with the event columns and one column per requested data element"""
+        data_elements = [de for value in params.get('dataElement', []) for de in value.split(',')]
+        names = list(GRID_COLUMNS) + data_elements
+        rows = []
+        for event in events:
+            values = {dv['dataElement']: dv['value'] for dv in event['dataValues']}
+            rows.append([event.get(name, '') for name in GRID_COLUMNS] + [values.get(de, '') for de in data_elements])
+        page = self.page('rows', rows, params)
+        grid = {'headers': [{'name': name, 'column': name} for name in names], 'rows': page['rows'],
+                'width': len(names), 'height': len(page['rows'])}
+        if 'pager' in page:
+            grid['metaData'] = {'pager': page['pager']}
+        return grid
+
+    def update_event(self, event):
+        stored = self.index[('events', event['event'])]
+        values = {dv['dataElement']: dv for dv in stored['dataValues']}
+        values.update((dv['dataElement'], dv) for dv in event.get('dataValues', []))
+        stored['dataValues'] = list(values.values())
+        stored['lastUpdated'] = datetime.now().isoformat()
+
+    def import_metadata(self, body):
+        stats = {'created': 0, 'updated': 0}
+        for collection, objects in body.items():
+            for obj in objects:
+                stored = self.index.get((collection, obj['id']))
+                if stored is None:
+                    self.data.setdefault(collection, []).append(obj)
+                    self.index[(collection, obj['id'])] = obj
+                    stats['created'] += 1
+                else:
+                    stored.update(obj)
+                    stats['updated'] += 1
+        return {'status': 'OK', 'stats': stats, 'typeReports': []}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately - don't let the body wait for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def respond(self):
+                with fake._lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+                if not url.path.startswith(PREFIX + '/api/'):
+                    status, payload = 404, {'httpStatusCode': 404}
+                else:
+                    with fake._lock:
+                        status, payload = fake.handle(self.command, url.path[len(PREFIX + '/api/'):],
+                                                      parse_qs(url.query), body)
+                content = json.dumps(payload).encode('utf-8') if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = respond
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
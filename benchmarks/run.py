@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Run every hnqis-* command against a local FakeDhis2 and report wall time and requests/sec.
+
+    python -m benchmarks.run --latency=0.02 --rows=2000 --output=bench.json
+    python -m benchmarks.run --latency=0.02 --rows=2000 --baseline=bench.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from src.backup import BACKUP_DIR, load_manifest
+from src.utils import write_csv
+
+from .fake_dhis2 import ATTRIBUTE_UID, USER_MESSAGE_UID, FakeDhis2, uid
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def attribute_csv(directory, rows, programs):
+    filename = os.path.join(directory, 'attributes.csv')
+    write_csv([[uid('O', i), u"value {}".format(i)] for i in range(rows)], filename, ['key', 'value'])
+    return filename
+
+
+def wide_attribute_csv(directory, rows, programs):
+    filename = os.path.join(directory, 'attributes_wide.csv')
+    write_csv([[uid('O', i), u"value {}".format(i), u"message {}".format(i)] for i in range(rows)], filename,
+              ['key', ATTRIBUTE_UID, USER_MESSAGE_UID])
+    return filename
+
+
+def program_orgunit_csv(directory, rows, programs):
+    filename = os.path.join(directory, 'program_orgunits.csv')
+    header = ['orgunit'] + [uid('P', p) for p in range(programs)]
+    write_csv([[uid('O', i)] + ['yes' if (i + p) % 2 else 'no' for p in range(programs)] for i in range(rows)],
+              filename, header)
+    return filename
+
+
+def user_message_csv(directory, rows, programs):
+    filename = os.path.join(directory, 'user_messages.csv')
+    write_csv([[u"user{}".format(i), u"Hi user{}!".format(i)] for i in range(rows)], filename, ['username', 'message'])
+    return filename
+
+
+def latest_backup(directory, rows, programs):
+    return os.path.join(directory, BACKUP_DIR, load_manifest(os.path.join(directory, BACKUP_DIR))[-1]['file'])
+
+
+# name, module, arguments (with a fixture function that returns a file name in place of a file)
+SCENARIOS = [
+    ('hnqis-attribute-setting', 'src.attribute_setter',
+     ['-c', attribute_csv, '-t', 'organisationUnits', '-a', ATTRIBUTE_UID, '-w', '8']),
+    ('hnqis-attribute-setting -b', 'src.attribute_setter',
+     ['-c', attribute_csv, '-t', 'organisationUnits', '-a', ATTRIBUTE_UID, '-b', '200']),
+    ('hnqis-attribute-setting wide', 'src.attribute_setter',
+     ['-c', wide_attribute_csv, '-t', 'organisationUnits', '-w', '8']),
+    ('hnqis-program-orgunit', 'src.program_orgunit_assigner', ['-c', program_orgunit_csv, '--no-cache']),
+    ('hnqis-program-orgunit --delta', 'src.program_orgunit_assigner',
+     ['-c', program_orgunit_csv, '--no-cache', '--delta']),
+    ('hnqis-restore', 'src.restore', ['-f', latest_backup]),
+    ('hnqis-indicator-update', 'src.indicator_healtharea_updater', []),
+    ('hnqis-indicator-update --sweep', 'src.indicator_healtharea_updater', ['--sweep']),
+    ('hnqis-user-message', 'src.user_message', ['-c', user_message_csv, '-w', '8']),
+    ('hnqis-scan-mismatches -x', 'src.scan_event_mismatches', ['-x', '--parallel', '4', '--no-cache'])
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the hnqis-* commands against a local fake DHIS2")
+    parser.add_argument('--latency', dest='latency', action='store', type=float, default=0.01,
+                        help="Seconds the fake server waits before answering a request, default: 0.01")
+    parser.add_argument('--rows', dest='rows', action='store', type=int, default=1000,
+                        help="CSV rows, orgunits and users, default: 1000")
+    parser.add_argument('--programs', dest='programs', action='store', type=int, default=10,
+                        help="Number of programs, default: 10")
+    parser.add_argument('--events', dest='events', action='store', type=int, default=2000,
+                        help="Events per program, default: 2000")
+    parser.add_argument('--values', dest='extra_values', action='store', type=int, default=0,
+                        help="Data values of other questions per event (real assessments have 200+), default: 0")
+    parser.add_argument('--dhis2-version', dest='version', action='store', default='2.32.0',
+                        help="DHIS2 version the fake server reports, default: 2.32.0")
+    parser.add_argument('--repeat', dest='repeat', action='store', type=int, default=1,
+                        help="Runs per scenario, the fastest counts, default: 1")
+    parser.add_argument('-k', dest='only', action='store',
+                        help="Only run scenarios containing this text, e.g. -k=scan")
+    parser.add_argument('--output', dest='output', action='store', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', dest='baseline', action='store',
+                        help="Compare with results written by --output and exit with 1 on regressions")
+    parser.add_argument('--tolerance', dest='tolerance', action='store', type=float, default=0.2,
+                        help="Wall time increase over the baseline that counts as a regression, default: 0.2")
+    return parser.parse_args()
+
+
+def run_scenario(args, directory, module, arguments):
+    """Run a command against a fresh fake server, return (wall seconds, requests)"""
+    server = FakeDhis2(latency=args.latency, version=args.version, orgunits=args.rows, users=args.rows,
+                       programs=args.programs, events=args.events, extra_values=args.extra_values).start()
+    try:
+        argv = [sys.executable, '-m', module, '-s', server.url, '-u', 'admin', '-p', 'district']
+        argv += [a(directory, args.rows, args.programs) if callable(a) else a for a in arguments]
+        env = dict(os.environ, PYTHONPATH=HERE, XDG_CACHE_HOME=os.path.join(directory, 'cache'))
+        with open(os.path.join(directory, 'output.log'), 'a') as log:
+            start = time.time()
+            subprocess.check_call(argv, cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+            return time.time() - start, server.requests
+    finally:
+        server.stop()
+
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp(prefix='hnqis-bench-')
+    results = {}
+    try:
+        print(u"{:<34}{:>10}{:>10}{:>12}".format('scenario', 'wall (s)', 'requests', 'requests/s'))
+        for name, module, arguments in SCENARIOS:
+            if args.only and args.only not in name:
+                continue
+            runs = [run_scenario(args, directory, module, arguments) for _ in range(max(1, args.repeat))]
+            wall, requests = min(runs)
+            results[name] = {'wall': wall, 'requests': requests, 'requests_per_second': requests / wall}
+            print(u"{:<34}{:>10.2f}{:>10}{:>12.1f}".format(name, wall, requests, requests / wall))
+    except subprocess.CalledProcessError:
+        with open(os.path.join(directory, 'output.log')) as log:
+            print(log.read())
+        raise
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = 0
+        for name in sorted(set(results) & set(baseline)):
+            change = results[name]['wall'] / baseline[name]['wall'] - 1
+            regressed = change > args.tolerance
+            regressions += regressed
+            print(u"{:<34}{:>+9.0%}{}".format(name, change, '  REGRESSION' if regressed else ''))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -91,16 +91,18 @@ setup(
     author=AUTHOR,
     author_email=EMAIL,
     url=URL,
-    packages=find_packages(exclude=('tests',)),
+    packages=find_packages(exclude=('tests', 'benchmarks')),
     # If your package is a single module, use this instead of 'packages':
     # py_modules=['mypackage'],
     entry_points={
         'console_scripts': [
+            'hnqis=src.cli:main',
             'hnqis-attribute-setting=src.attribute_setter:main',
             'hnqis-program-orgunit=src.program_orgunit_assigner:main',
             'hnqis-indicator-update=src.indicator_healtharea_updater:main',
             'hnqis-user-message=src.user_message:main',
-            'hnqis-scan-mismatches=src.scan_event_mismatches:main'
+            'hnqis-scan-mismatches=src.scan_event_mismatches:main',
+            'hnqis-restore=src.restore:main'
         ],
     },
     install_requires=REQUIRED,
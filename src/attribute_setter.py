@@ -2,10 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import time
+import json
 from copy import deepcopy
 
-from dhis2 import Api, setup_logger, logger, load_csv, is_valid_uid
+from .journal import Journal, journal_filename
+from .lazy import load_csv, logger, setup_logger
+from .metrics import add_metrics_arguments, phase
+from .planner import Plan
+from .utils import chunk, import_report_errors, positive_int, post_metadata, run_concurrently
+from .validation import check, is_uid, report_filename, validate_rows
 
 OBJ_TYPES = {
     "categoryOptions",
@@ -34,15 +39,23 @@ OBJ_TYPES = {
     "userGroups"
 }
 
+# objects requested to sample their size for --plan
+PLAN_SAMPLE_SIZE = 10
+
 
 def parse_args():
-    usage = "hnqis-attribute-setting [-s] [-u] [-p] -c -t -a" \
+    usage = "hnqis-attribute-setting [-s] [-u] [-p] -c -t [-a] [-b] [-w] [--plan] [--resume] [--metrics] [--trace]" \
             "\n\n\033[1mExample:\033[0m " \
             "\nhnqis-attribute-setting -s=data.psi-mis.org -u=admin -p=district -c=/path/to/file.csv -t=organisationUnits -a=pt5Ll9bb2oP" \
             "\n\n\033[1mCSV file structure:\033[0m         " \
             "\nkey     | value                             " \
             "\n--------|--------                           " \
             "\nUID     | myValue                          " \
+            "\n                                            " \
+            "\n\033[1mWithout -a, one column per Attribute:\033[0m" \
+            "\nkey     | pt5Ll9bb2oP | ct3X8eB5gRj         " \
+            "\n--------|-------------|-------------        " \
+            "\nUID     | myValue     | (empty: not set)    " \
             "\n                                            "
     parser = argparse.ArgumentParser(
         description="Post Attribute Values sourced from CSV file", usage=usage)
@@ -52,90 +65,276 @@ def parse_args():
                         required=True)
     parser.add_argument('-t', dest='object_type', action='store', help="DHIS2 object type to set attribute values",
                         required=True, choices=OBJ_TYPES)
-    parser.add_argument('-a', dest='attribute_uid', action='store', help='Attribute UID', required=True)
+    parser.add_argument('-a', dest='attribute_uid', action='store', required=False,
+                        help="Attribute UID of a key,value CSV - without it, the CSV headers are Attribute UIDs")
+    parser.add_argument('-b', dest='batch_size', action='store', type=positive_int, required=False,
+                        help="Bulk mode: fetch and import objects via /api/metadata in chunks of this size, e.g. -b=100")
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=positive_int, default=1,
+                        required=False, help="Number of objects to update concurrently, e.g. -w=8")
+    parser.add_argument('--plan', dest='plan', action='store_true', default=False, required=False,
+                        help="Only estimate requests, transferred bytes and runtime of this run (read-only)")
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False, required=False,
+                        help="Skip rows already applied by a previous run (recorded in <CSV>_journal.jsonl)")
     parser.add_argument('-u', dest='username', action='store', help="DHIS2 username")
     parser.add_argument('-p', dest='password', action='store', help="DHIS2 password")
     parser.add_argument('-d', dest='debug', action='store_true', default=False, required=False,
                         help="Writes more info in log file")
 
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
-def validate_csv(data):
-    if not data[0].get('key', None) or not data[0].get('value', None):
-        raise ValueError("CSV not valid: CSV must have 'key' and 'value' as headers")
+def validate_csv(data, report=None, wide=False):
+    """Validate rows (any iterable, e.g. load_csv) in one pass, optionally writing all errors to a CSV report.
+    A `wide` CSV has a key column and one column per Attribute UID."""
+    if wide:
+        return check(validate_rows(data, required=['key'], key='key', uid_headers=True), report)
+    return check(validate_rows(data, required=['key', 'value'], key='key'), report)
+
 
-    object_uids = [obj['key'] for obj in data]
-    for uid in object_uids:
-        if not is_valid_uid(uid):
-            raise ValueError("Object {} is not a valid UID in the CSV".format(uid))
-    if len(object_uids) != len(set(object_uids)):
-        raise ValueError("Duplicate Objects (rows) found in the CSV")
-    return True
+def row_values(row, attribute_uid=None):
+    """Attribute UID -> value of a CSV row: its value of `attribute_uid`, or every non-empty cell of a wide CSV"""
+    if attribute_uid:
+        return {attribute_uid: row['value']}
+    return {h: v for h, v in row.items() if h != 'key' and h is not None and v}
 
 
-def create_or_update_attributevalues(obj, attribute_uid, attribute_value):
+def create_or_update_attributevalues(obj, attribute_uid=None, attribute_value=None, values=None):
+    """Return a copy of `obj` with the value of `attribute_uid` set - or of every Attribute UID in `values`"""
+    values = dict(values or {})
+    if attribute_uid:
+        values[attribute_uid] = attribute_value
     obj_copy = deepcopy(obj)
-    updated = {
-        "value": attribute_value,
-        "attribute": {
-            "id": attribute_uid,
+    # keep the values of other attributes, replace existing values of the target UIDs
+    old = [x for x in obj.get('attributeValues') or [] if x['attribute']['id'] not in values]
+    obj_copy['attributeValues'] = old
+    for uid in sorted(values):
+        obj_copy['attributeValues'].append({
+            "value": values[uid],
+            "attribute": {
+                "id": uid,
+            }
+        })
+    return obj_copy
+
+
+def patch_object(api, object_type, obj_uid, values):
+    """Fetch only the attribute values of a single object and replace them with a JSON Patch"""
+    params_get = {'fields': 'id,attributeValues'}
+    obj_old = api.get('{}/{}'.format(object_type, obj_uid), params=params_get).json()
+    obj_updated = create_or_update_attributevalues(obj=obj_old, values=values)
+    api.json_patch('{}/{}'.format(object_type, obj_uid), attributevalues_patch(obj_updated))
+
+
+def attributevalues_patch(obj):
+    """JSON Patch setting the attributeValues of an object to those of `obj`"""
+    return [{'op': 'add', 'path': '/attributeValues', 'value': obj['attributeValues']}]
+
+
+def update_object(api, object_type, obj_uid, values, patch=False):
+    """Fetch a single object, set its attribute values and PUT it back - or PATCH them if `patch` is set.
+    If the server rejects the PATCH, the object is updated with a PUT."""
+    if patch and api.supports_json_patch:
+        from dhis2 import RequestException
+        try:
+            return patch_object(api, object_type, obj_uid, values)
+        except RequestException:
+            if api.supports_json_patch:
+                raise
+    params_get = {'fields': ':owner'}
+    obj_old = api.get('{}/{}'.format(object_type, obj_uid), params=params_get).json()
+    obj_updated = create_or_update_attributevalues(obj=obj_old, values=values)
+    api.put('{}/{}'.format(object_type, obj_uid), params=None, data=obj_updated)
+
+
+def import_metadata(api, object_type, objects):
+    """POST objects to /api/metadata (non-atomic) and return the UIDs rejected by the import"""
+    params_post = {
+        'importStrategy': 'UPDATE',
+        'atomicMode': 'NONE'
+    }
+    report = post_metadata(api, {object_type: objects}, params_post)
+    errors = import_report_errors(report, objects)
+    for uid, messages in errors.items():
+        logger.warn(u"Import rejected {}: {}".format(uid, ' '.join(messages)))
+    return set(errors)
+
+
+def update_objects_bulk(api, object_type, rows, batch_size, journal=None):
+    """Fetch objects in chunks with an `id:in` filter, set attribute values and import every chunk at once.
+    `rows` are (object UID, {Attribute UID: value}) tuples.
+    Objects rejected by the bulk import are retried one by one with a PUT - a failed PUT is logged.
+    Updated objects of every chunk are recorded in the `journal`."""
+    values = dict(rows)
+    done = 0
+    for uids in chunk([obj_uid for obj_uid, _ in rows], batch_size):
+        params_get = {
+            'fields': ':owner',
+            'filter': 'id:in:[{}]'.format(','.join(uids)),
+            'paging': False
         }
+        objects = api.get(object_type, params=params_get).json()[object_type]
+        missing = set(uids) - set([o['id'] for o in objects])
+        for obj_uid in missing:
+            logger.warn(u"{} {} not found. Skipping...".format(object_type[:-1], obj_uid))
+
+        updated = [create_or_update_attributevalues(obj=o, values=values[o['id']]) for o in objects]
+        rejected = import_metadata(api, object_type, updated) if updated else set()
+        failed = set()
+        for obj_uid in rejected:
+            if obj_uid not in values:
+                logger.error(u"Import rejected an object that could not be matched to a row: {}".format(obj_uid))
+                continue
+            try:
+                update_object(api, object_type, obj_uid, values[obj_uid])
+            except Exception as e:
+                logger.error(u"failed: {} {}".format(obj_uid, e))
+                failed.add(obj_uid)
+            else:
+                logger.info(u"Updated AttributeValues via PUT: {} - {}: {}".format(format_values(values[obj_uid]),
+                                                                                    object_type[:-1], obj_uid))
+        applied = [o['id'] for o in objects if o['id'] not in failed]
+        if journal is not None and applied:
+            journal.record(*[e for obj_uid in applied for e in journal_entries(object_type, obj_uid, values[obj_uid])])
+        done += len(uids)
+        logger.info(u"{}/{} - Updated AttributeValues of {} {}".format(done, len(rows), len(objects), object_type))
+
+
+def format_values(values):
+    if len(values) == 1:
+        return u"{}".format(list(values.values())[0])
+    return u", ".join(u"{}={}".format(uid, values[uid]) for uid in sorted(values))
+
+
+def journal_entries(object_type, obj_uid, values):
+    """Journal entries of an object: one per Attribute value"""
+    return [(object_type, uid, obj_uid, values[uid]) for uid in sorted(values)]
+
+
+def check_attributes(api, object_type, attribute_uids):
+    """Check in one request that all Attributes exist and are assigned to `object_type`, raise a ValueError if not"""
+    assigned = '{}Attribute'.format(object_type[:-1])
+    params_get = {
+        'fields': 'id,name,{}'.format(assigned),
+        'filter': 'id:in:[{}]'.format(','.join(attribute_uids)),
+        'paging': False
     }
-    # if no single attribute is set
-    if not obj.get('attributeValues', None):
-        obj_copy['attributeValues'] = [updated]
-        return obj_copy
-
-    if len(obj['attributeValues']) == 1 and attribute_uid in [x['attribute']['id'] for x in obj['attributeValues']]:
-        # just one attribute matching to target UID
-        obj_copy['attributeValues'] = [updated]
-        return obj_copy
+    attributes = {a['id']: a for a in api.get('attributes', params=params_get).json()['attributes']}
+    errors = []
+    for uid in attribute_uids:
+        if uid not in attributes:
+            errors.append(u"Attribute {} not found".format(uid))
+        elif attributes[uid].get(assigned) is False:
+            errors.append(u"Attribute {} is not assigned to type {}".format(uid, object_type[:-1]))
+    for error in errors:
+        logger.error(error)
+    if errors:
+        raise ValueError(u"{} of {} Attributes can't be set - nothing was updated".format(len(errors),
+                                                                                          len(attribute_uids)))
+
+
+def plan_run(api, args, data):
+    """Estimate the run from the size of the first of the first PLAN_SAMPLE_SIZE objects the server returns"""
+    plan = Plan(api, workers=1 if args.batch_size else args.workers)
+    patch = not args.batch_size and api.supports_json_patch
+    params_get = {
+        'fields': 'id,attributeValues' if patch else ':owner',
+        'filter': 'id:in:[{}]'.format(','.join(obj_uid for obj_uid, _ in data[:PLAN_SAMPLE_SIZE])),
+        'paging': False
+    }
+    sample = api.get(args.object_type, params=params_get).json()[args.object_type]
+    if not sample:
+        plan.note(u"None of the first {} {} were found - transferred bytes are not estimated".format(
+            min(len(data), PLAN_SAMPLE_SIZE), args.object_type))
+    size = len(json.dumps(sample[0])) if sample else 0
+    total = size * len(data)
+    if args.batch_size:
+        chunks = -(-len(data) // args.batch_size)
+        plan.add(u"fetch objects in chunks", 'GET', args.object_type, chunks, download=total)
+        plan.add(u"import chunks", 'POST', 'metadata', chunks, upload=total)
     else:
-        # there are more than 1 attribute values.
-        # extract all values except target UID (if existing) and add target value.
-        old = [x for x in obj['attributeValues'] if x['attribute']['id'] != attribute_uid]
-        obj_copy['attributeValues'] = old
-        obj_copy['attributeValues'].append(updated)
-        return obj_copy
+        endpoint = '{}/<uid>'.format(args.object_type)
+        plan.add(u"fetch objects", 'GET', endpoint, len(data), download=total, concurrent=True)
+        plan.add(u"update objects", 'PATCH' if patch else 'PUT', endpoint, len(data), upload=total, concurrent=True)
+    return plan
 
 
 def main():
     args = parse_args()
     setup_logger()
 
-    api = Api(server=args.server, username=args.username, password=args.password)
+    from .client import create_api
+    api = create_api(args, pool_size=args.workers)
 
-    if not is_valid_uid(args.attribute_uid):
+    if args.attribute_uid and not is_uid(args.attribute_uid):
         logger.error("Attribute {} is not a valid UID".format(args.attribute_uid))
 
-    data = list(load_csv(args.source_csv))
-    validate_csv(data)
+    wide = not args.attribute_uid
+    with phase('validate'):
+        validate_csv(load_csv(args.source_csv), report=report_filename(args.source_csv), wide=wide)
+    with phase('load_csv'):
+        data = list(load_csv(args.source_csv))
+        attribute_uids = [args.attribute_uid] if not wide else [h for h in data[0] if h != 'key']
+        rows = [(obj['key'], row_values(obj, args.attribute_uid)) for obj in data]
+        # blank cells of a wide CSV are not set
+        rows = [(obj_uid, values) for obj_uid, values in rows if values]
+
+    check_attributes(api, args.object_type, attribute_uids)
 
-    attr_get = {'fields': 'id,name,{}Attribute'.format(args.object_type[:-1])}
-    attr = api.get('attributes/{}'.format(args.attribute_uid), params=attr_get).json()
-    if attr['{}Attribute'.format(args.object_type[:-1])] is False:
-        logger.error("Attribute {} is not assigned to type {}".format(args.attribute_uid, args.object_type[:-1]))
+    journal = Journal(journal_filename(args.source_csv), resume=args.resume)
+
+    def entries(row):
+        return journal_entries(args.object_type, row[0], row[1])
+
+    pending = [row for row in rows if any(e not in journal for e in entries(row))]
+    if len(pending) < len(rows):
+        logger.info(u"Resuming - skipping {} rows already applied".format(len(rows) - len(pending)))
+        rows = pending
+    if not rows:
+        logger.info(u"All rows already applied")
+        return
+
+    if args.plan:
+        plan_run(api, args, rows).report()
+        return
 
     logger.info(
         "[{}] - Updating Attribute Values for Attribute \033[1m{}\033[0m for \033[1m{}\033[0m \033[1m{}\033[0m...".format(
-            args.server, args.attribute_uid, len(data), args.object_type))
-    try:
-        time.sleep(3)
-    except KeyboardInterrupt:
-        logger.warn("\033[1m{}\033[0m".format("Aborted!"))
-        pass
-
-    for i, obj in enumerate(data, 1):
-        obj_uid = obj.get('key')
-        attribute_value = obj.get('value')
-        params_get = {'fields': ':owner'}
-        obj_old = api.get('{}/{}'.format(args.object_type, obj_uid), params=params_get).json()
-        obj_updated = create_or_update_attributevalues(obj=obj_old, attribute_uid=args.attribute_uid,
-                                                       attribute_value=attribute_value)
-        api.put('{}/{}'.format(args.object_type, obj_uid), params=None, data=obj_updated)
-        logger.info(u"{}/{} - Updated AttributeValue: {} - {}: {}".format(i, len(data), attribute_value,
-                                                                                        args.object_type[:-1], obj_uid))
+            args.server, ', '.join(attribute_uids), len(rows), args.object_type))
+    if args.batch_size:
+        with journal, phase('update'):
+            update_objects_bulk(api, args.object_type, rows, args.batch_size, journal)
+        return
+
+    patch = api.supports_json_patch
+    if patch:
+        logger.info(u"Server supports JSON Patch - updating only Attribute Values")
+
+    def update_row(row):
+        update_object(api, args.object_type, row[0], row[1], patch)
+        journal.record(*entries(row))
+
+    with phase('update'):
+        failed = []
+        for i, (row, _, error) in enumerate(run_concurrently(update_row, rows, args.workers), 1):
+            obj_uid, values = row
+            if error:
+                logger.warn(u"{}/{} - Failed {}: {} - retrying later".format(i, len(rows), obj_uid, error))
+                failed.append(row)
+            else:
+                logger.info(u"{}/{} - Updated AttributeValue: {} - {}: {}".format(i, len(rows), format_values(values),
+                                                                                   args.object_type[:-1], obj_uid))
+
+        for row in failed:
+            obj_uid, values = row
+            try:
+                update_row(row)
+            except Exception as e:
+                logger.error(u"failed: {} {}".format(obj_uid, e))
+            else:
+                logger.info(u"Retried - Updated AttributeValue: {} - {}: {}".format(format_values(values),
+                                                                                     args.object_type[:-1], obj_uid))
+    journal.close()
 
 
 if __name__ == "__main__":
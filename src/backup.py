@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from datetime import datetime
+from threading import Lock
+
+BACKUP_DIR = 'backups'
+MANIFEST = 'manifest.json'
+
+_manifest_lock = Lock()
+
+
+class _HashingWriter(object):
+    """File-like object that encodes written JSON chunks, hashes them and writes them to `fp`"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+
+    def write(self, chunk):
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        self.sha256.update(chunk)
+        self.fp.write(chunk)
+
+
+def load_manifest(directory=BACKUP_DIR):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_backup(data, name, directory=BACKUP_DIR):
+    """Stream a metadata payload, e.g. {"programs": [...]}, as compact gzipped JSON into `directory`.
+    Files are named <name>_<timestamp>_<hash>.json.gz - if the same content was backed up before,
+    the existing file is reused. Every backup is recorded in the directory's manifest.json.
+    :return: path of the backup file
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    with gzip.open(tmp, 'wb') as gz:
+        writer = _HashingWriter(gz)
+        json.dump(data, writer, separators=(',', ':'))
+    digest = writer.sha256.hexdigest()
+    created = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+
+    with _manifest_lock:
+        manifest = load_manifest(directory)
+        existing = [entry['file'] for entry in manifest if entry['sha256'] == digest]
+        if existing and os.path.exists(os.path.join(directory, existing[0])):
+            os.remove(tmp)
+            filename = existing[0]
+        else:
+            filename = u"{}_{}_{}.json.gz".format(name, created, digest[:12])
+            os.rename(tmp, os.path.join(directory, filename))
+        manifest.append({
+            'name': name,
+            'created': created,
+            'file': filename,
+            'sha256': digest,
+            'objects': {key: len(value) for key, value in data.items() if isinstance(value, list)}
+        })
+        with open(os.path.join(directory, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    return os.path.join(directory, filename)
+
+
+def read_backup(path):
+    """Load a backup file and verify its content against the manifest next to it (if any)"""
+    with gzip.open(path, 'rb') as gz:
+        content = gz.read()
+    directory, filename = os.path.split(path)
+    for entry in load_manifest(directory or '.'):
+        if entry['file'] == filename and entry['sha256'] != hashlib.sha256(content).hexdigest():
+            raise ValueError(u"Backup {} does not match its checksum in {}".format(path, MANIFEST))
+    return json.loads(content.decode('utf-8'))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import time
+
+from .lazy import logger
+from .utils import atomic_open
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                         'hnqis-cli')
+TTL_SECONDS = 60 * 60
+MAX_BYTES = 50 * 1024 * 1024
+
+
+class Cache(object):
+    """On-disk cache of GET responses, keyed by server, username, endpoint and params. Failing to write
+    the cache is logged at debug level only.
+    Entries younger than `ttl` seconds are used as they are, older ones are revalidated with
+    an If-None-Match request (DHIS2 answers 304 Not Modified if the ETag still matches).
+    The least recently used entries are evicted when the cache grows beyond `max_bytes`."""
+
+    def __init__(self, directory=CACHE_DIR, ttl=TTL_SECONDS, max_bytes=MAX_BYTES, enabled=True):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+    def _path(self, api, endpoint, params):
+        key = json.dumps([api.base_url, api.username, endpoint, params], sort_keys=True)
+        return os.path.join(self.directory, '{}.json'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def _load(self, path):
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path, None)
+        except (IOError, OSError) as e:
+            logger.debug(u"Cache entry not touched: {}".format(e))
+        return entry
+
+    def _store(self, path, etag, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # concurrent runs never read a half-written entry
+        with atomic_open(path) as f:
+            json.dump({'etag': etag, 'stored': time.time(), 'data': data}, f)
+        self.evict()
+
+    def get(self, api, endpoint, params=None):
+        """GET endpoint with params (returns the JSON), served from the cache when possible"""
+        if not self.enabled:
+            return api.get(endpoint, params=params).json()
+
+        path = self._path(api, endpoint, params)
+        entry = self._load(path)
+        if entry and time.time() - entry['stored'] < self.ttl:
+            logger.debug(u"Cache hit: {}".format(endpoint))
+            return entry['data']
+
+        headers = {'If-None-Match': entry['etag']} if entry and entry.get('etag') else None
+        r = api.get(endpoint, params=params, headers=headers)
+        if r.status_code == 304:
+            logger.debug(u"Cache revalidated: {}".format(endpoint))
+            data = entry['data']
+        else:
+            data = r.json()
+        try:
+            self._store(path, r.headers.get('ETag'), data)
+        except (IOError, OSError) as e:
+            # e.g. a read-only or full cache directory - the cache must not fail the run
+            logger.debug(u"Cache not written: {}".format(e))
+        return data
+
+    def evict(self):
+        """Remove least recently used entries until the cache is smaller than max_bytes"""
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
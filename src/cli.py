@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""`hnqis <command>` front end: imports only the module of the chosen command"""
+
+import importlib
+import sys
+
+# command: (module, description)
+COMMANDS = [
+    ('attribute-setting', 'attribute_setter', "Post Attribute Values sourced from CSV file"),
+    ('program-orgunit', 'program_orgunit_assigner', "Assign OrgUnits to Programs sourced from CSV file"),
+    ('indicator-update', 'indicator_healtharea_updater',
+     "Update integrated Health area indicator numerators with all programIndicators"),
+    ('user-message', 'user_message', "Post Message (User Attribute Value) sourced from CSV file"),
+    ('scan-mismatches', 'scan_event_mismatches', "Scan (and fix) Events where Overall Score != _Overall Score"),
+    ('restore', 'restore', "Restore a backup written by hnqis-* commands via /api/metadata")
+]
+
+
+def usage():
+    lines = [u"usage: hnqis <command> [<args>]", u"", u"\033[1mCommands:\033[0m"]
+    lines.extend(u"  {:<20}{}".format(name, description) for name, _, description in COMMANDS)
+    lines.extend([u"", u"Get help on a command with e.g. hnqis {} --help".format(COMMANDS[0][0])])
+    return u"\n".join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return
+    modules = {name: module for name, module, _ in COMMANDS}
+    if argv[0] not in modules:
+        print(usage())
+        sys.exit(u"\nhnqis: unknown command '{}'".format(argv[0]))
+
+    module = importlib.import_module('.{}'.format(modules[argv[0]]), __package__)
+    # the command parses sys.argv, as if it was run as hnqis-<command>
+    sys.argv = [u"hnqis {}".format(argv[0])] + argv[1:]
+    module.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import atexit
+import json
+import time
+from collections import defaultdict
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from dhis2 import Api, RequestException, logger
+
+from .metrics import METRICS
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# a POST (e.g. a metadata or event import) may have been committed when a 5xx or a lost response comes back
+RETRY_STATUS_CODES_POST = {429}
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+POOL_SIZE = 10
+# seconds to (connect, read) - a metadata import may take minutes before DHIS2 answers
+TIMEOUT = (10, 600)
+JSON_PATCH_VERSION = 37
+# a server answering JSON Patch with these does not apply it
+JSON_PATCH_REJECTED_STATUS_CODES = {405, 415}
+
+
+def backoff(attempt):
+    """Seconds to wait before retry number `attempt` (starting at 0): 1, 2, 4, ... capped at BACKOFF_MAX_SECONDS"""
+    return min(BACKOFF_MAX_SECONDS, BACKOFF_SECONDS * 2 ** attempt)
+
+
+def sent(error):
+    """False if a requests ConnectionError/Timeout was raised while connecting, i.e. before the request was sent"""
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    # urllib3's NewConnectionError (connection refused, DNS failure) is a ConnectTimeoutError
+    return not isinstance(reason, ConnectTimeoutError)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout - dhis2.Api sends requests without one"""
+
+    def __init__(self, timeout=TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+class Client(Api):
+    """dhis2.Api with a sized keep-alive connection pool, (connect, read) timeouts, retries with
+    exponential backoff on 429/5xx responses and connection errors, and request timings per endpoint.
+    POST is only retried on 429 and on connection errors before the request was sent."""
+
+    def __init__(self, server, username, password, pool_size=POOL_SIZE, retries=MAX_RETRIES, timeout=TIMEOUT,
+                 **kwargs):
+        super(Client, self).__init__(server, username, password, **kwargs)
+        self.retries = retries
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.json_patch_rejected = False
+        self.timings = defaultdict(list)
+        # bytes [sent, received] per endpoint
+        self.transferred = defaultdict(lambda: [0, 0])
+        self._lock = Lock()
+
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+    @pool_size.setter
+    def pool_size(self, size):
+        self._pool_size = max(1, size)
+        adapter = TimeoutHTTPAdapter(timeout=self.timeout, pool_connections=self._pool_size,
+                                     pool_maxsize=self._pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _make_request(self, method, endpoint, **kwargs):
+        post = method == 'post'
+        status_codes = RETRY_STATUS_CODES_POST if post else RETRY_STATUS_CODES
+        attempt = 0
+        while True:
+            start = time.time()
+            response = None
+            try:
+                response = self._send(method, endpoint, **kwargs)
+                return response
+            except RequestException as e:
+                if e.code not in status_codes or attempt >= self.retries:
+                    raise
+                error = e.code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries or (post and sent(e)):
+                    raise
+                error = e.__class__.__name__
+            finally:
+                self._record(method, endpoint, time.time() - start, response, kwargs.get('stream'))
+            delay = backoff(attempt)
+            logger.warning(u"{} {} failed ({}) - retrying in {}s...".format(method.upper(), endpoint, error, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, endpoint, file_type='json', params=None, stream=False, headers=None):
+        """GET from DHIS2, see dhis2.Api.get - optionally with extra HTTP headers, e.g. If-None-Match"""
+        return self._make_request('get', endpoint, params=params, file_type=file_type, stream=stream,
+                                  headers=headers)
+
+    def json_patch(self, endpoint, operations, params=None):
+        """PATCH a list of JSON Patch operations (RFC 6902), supported from DHIS2 2.37 on (see supports_json_patch).
+        If the server rejects it with 405/415, supports_json_patch is False for the rest of the run."""
+        try:
+            return self._make_request('patch', endpoint, data=operations, params=params,
+                                      headers={'Content-Type': 'application/json-patch+json'})
+        except RequestException as e:
+            if e.code in JSON_PATCH_REJECTED_STATUS_CODES:
+                with self._lock:
+                    if not self.json_patch_rejected:
+                        logger.warning(u"Server rejected JSON Patch ({}) - updating with PUT".format(e.code))
+                    self.json_patch_rejected = True
+            raise
+
+    @property
+    def supports_json_patch(self):
+        """True if the server applies JSON Patch - its version is read from /api/system/info once.
+        False if the version can't be parsed or a PATCH was rejected."""
+        if self.json_patch_rejected or self.version_int is None:
+            return False
+        return self.version_int >= JSON_PATCH_VERSION
+
+    def _send(self, method, endpoint, **kwargs):
+        data = kwargs.get('data')
+        if method == 'get' and kwargs.get('headers'):
+            # dhis2.Api does not send request headers
+            params = kwargs.get('params')
+            file_type = kwargs.get('file_type') or 'json'
+            self._validate_request(endpoint, file_type, params=params)
+            r = self.session.get('{}/{}.{}'.format(self.api_url, endpoint, file_type), params=params,
+                                 headers=kwargs['headers'], stream=kwargs.get('stream', False))
+            return self._validate_response(r)
+        if method == 'delete' and data:
+            # dhis2.Api does not send a payload with DELETE, which collection endpoints need
+            params = kwargs.get('params')
+            self._validate_request(endpoint, data=data, params=params)
+            r = self.session.delete(url='{}/{}'.format(self.api_url, endpoint), json=data, params=params)
+            return self._validate_response(r)
+        if method == 'patch' and kwargs.get('headers'):
+            # dhis2.Api only sends dicts as application/json - a JSON Patch is a list
+            params = kwargs.get('params')
+            self._validate_request(endpoint, params=params)
+            r = self.session.patch('{}/{}'.format(self.api_url, endpoint), data=json.dumps(data), params=params,
+                                   headers=kwargs['headers'])
+            return self._validate_response(r)
+        return super(Client, self)._make_request(method, endpoint, **kwargs)
+
+    def _record(self, method, endpoint, seconds, response=None, stream=False):
+        # group e.g. events/{uid} under events
+        key = u"{} {}".format(method.upper(), endpoint.split('/')[0])
+        sent = received = 0
+        if response is not None:
+            if response.request is not None and response.request.body:
+                sent = len(response.request.body)
+            if not stream:
+                received = len(response.content or b'')
+        METRICS.add_span('network', key, time.time() - seconds, seconds)
+        with self._lock:
+            self.timings[key].append(seconds)
+            self.transferred[key][0] += sent
+            self.transferred[key][1] += received
+
+    def log_timings(self):
+        """Log number of requests and mean/max duration per endpoint"""
+        for key in sorted(self.timings):
+            seconds = self.timings[key]
+            logger.info(u"{}: {} requests, mean {:.3f}s, max {:.3f}s, total {:.1f}s".format(
+                key, len(seconds), sum(seconds) / len(seconds), max(seconds), sum(seconds)))
+
+
+def create_api(args, pool_size=POOL_SIZE):
+    """Create a Client from the -s/-u/-p arguments or from a dish.json file if no server was given.
+    Request timings are logged when the command exits, as well as --metrics and --trace files if given."""
+    if args.server:
+        api = Client(server=args.server, username=args.username, password=args.password, pool_size=pool_size)
+    else:
+        api = Client.from_auth_file()
+        api.pool_size = pool_size
+    atexit.register(api.log_timings)
+    metrics_file, trace_file = getattr(args, 'metrics_file', None), getattr(args, 'trace_file', None)
+    if metrics_file or trace_file:
+        atexit.register(METRICS.write, api, metrics_file, trace_file)
+    return api
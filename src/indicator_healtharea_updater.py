@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import time
 import json
-from datetime import datetime
 import sys
+from multiprocessing.pool import ThreadPool
 
-from dhis2 import Api, setup_logger, logger
+from .backup import write_backup
+from .lazy import logger, setup_logger
+from .metrics import add_metrics_arguments, phase
+from .planner import Plan
+from .utils import positive_int
 
 HEALTH_AREAS = [
     'CC',
@@ -31,21 +34,30 @@ HEALTH_AREAS = [
     'WASH',
     'WEA',
 ]
+WORKERS = 20
+PAGE_SIZE = 1000
 
 
 def parse_args():
-    usage = "hnqis-indicator-update [-s] [-u] [-p]" \
+    usage = "hnqis-indicator-update [-s] [-u] [-p] [-w] [--sweep] [--plan] [--metrics] [--trace]" \
             "\n\n\033[1mExample:\033[0m " \
             "\nhnqis-indicator-update -s=data.psi-mis.org -u=admin -p=district"
     parser = argparse.ArgumentParser(
         description="Update integrated Health area indicator numerators with all programIndicators",
         usage=usage)
     parser.add_argument('-s', dest='server', action='store', help="Server URL without /api/ e.g. -s=data.psi-mis.org")
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=positive_int, default=WORKERS,
+                        required=False, help="Number of queries to run at the same time, default: {}".format(WORKERS))
+    parser.add_argument('--sweep', dest='sweep', action='store_true', default=False, required=False,
+                        help="Download all HNQIS metadata in three requests and sort it into health areas locally")
+    parser.add_argument('--plan', dest='plan', action='store_true', default=False, required=False,
+                        help="Only estimate requests, transferred bytes and runtime of this run (read-only)")
     parser.add_argument('-u', dest='username', action='store', help="DHIS2 username")
     parser.add_argument('-p', dest='password', action='store', help="DHIS2 password")
     parser.add_argument('-d', dest='debug', action='store_true', default=False, required=False,
                         help="Writes more info in log file")
 
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
@@ -57,11 +69,116 @@ def create_numerator(programindicators_uid_list):
     return numerator
 
 
+def health_area_queries(ha):
+    """Return (endpoint, params) of the programIndicators, indicators and programs queries of a health area"""
+    # VMMC splits do not have their own HA
+    if ha == 'VMMC':
+        p1 = {
+            'paging': False,
+            'filter': [
+                'name:like:HNQIS - {}'.format(ha),
+                'name:like$:count',
+                'program.name:!like:v1'  # don't get v1 programIndicators
+            ],
+            'fields': '[id,name]'
+        }
+    else:
+        p1 = {
+            'paging': False,
+            'filter': [
+                'name:like:HNQIS - {} count'.format(ha),
+                'program.name:!like:v1'  # don't get v1 programIndicators
+            ],
+            'fields': '[id,name]'
+        }
+
+    p2 = {
+        'paging': False,
+        'filter': ['name:eq:HNQIS - {} count'.format(ha)],
+        'fields': ':owner'
+    }
+
+    p3 = {
+        'paging': False,
+        'filter': [
+            'shortName:like: HNQIS {}'.format(ha),  # 2.30 would need to change filters
+            'name:!like:v1'
+        ],
+        'fields': 'id,name'
+    }
+    return [('programIndicators', p1), ('indicators', p2), ('programs', p3)]
+
+
+def fetch_health_areas(api, workers=WORKERS):
+    """Run the queries of all HEALTH_AREAS concurrently on `workers` threads.
+    Returns (health area, programIndicators, indicators, programs) tuples in HEALTH_AREAS order."""
+    queries = [query for ha in HEALTH_AREAS for query in health_area_queries(ha)]
+
+    def get(query):
+        endpoint, params = query
+        return api.get(endpoint, params=params).json()[endpoint]
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        results = pool.map(get, queries)
+    finally:
+        pool.terminate()
+    return [(ha,) + tuple(results[i * 3:i * 3 + 3]) for i, ha in enumerate(HEALTH_AREAS)]
+
+
+def filter_predicate(dhis2_filter):
+    """Compile a DHIS2 metadata filter like 'program.name:!like:v1' into a function that
+    evaluates it against an object. Supports the operators used in health_area_queries."""
+    path, operator, value = dhis2_filter.split(':', 2)
+    keys = path.split('.')
+    operators = {
+        'eq': lambda v: v == value,
+        'like': lambda v: value in v,
+        '!like': lambda v: value not in v,
+        'like$': lambda v: v.endswith(value)
+    }
+    if operator not in operators:
+        raise ValueError(u"Filter operator not supported: {}".format(dhis2_filter))
+    compare = operators[operator]
+
+    def predicate(obj):
+        for key in keys:
+            obj = (obj or {}).get(key)
+        return compare(obj or '')
+    return predicate
+
+
+def classify(programindicators, indicators, programs):
+    """Sort objects into HEALTH_AREAS with the same rules as the filters of health_area_queries.
+    Returns (health area, programIndicators, indicators, programs) tuples in HEALTH_AREAS order."""
+    objects = {'programIndicators': programindicators, 'indicators': indicators, 'programs': programs}
+    results = []
+    for ha in HEALTH_AREAS:
+        result = [ha]
+        for endpoint, params in health_area_queries(ha):
+            predicates = [filter_predicate(f) for f in params['filter']]
+            result.append([o for o in objects[endpoint] if all(p(o) for p in predicates)])
+        results.append(tuple(result))
+    return results
+
+
+def fetch_health_areas_sweep(api, page_size=PAGE_SIZE):
+    """Download all HNQIS programIndicators, indicators and programs with one paged request each
+    and classify them locally"""
+    sweeps = [
+        ('programIndicators', 'name:like:HNQIS', 'id,name,program[name]'),
+        ('indicators', 'name:like:HNQIS', ':owner'),
+        ('programs', 'shortName:like:HNQIS', 'id,name,shortName')
+    ]
+    objects = []
+    for endpoint, dhis2_filter, fields in sweeps:
+        params = {'filter': dhis2_filter, 'fields': fields}
+        objects.append(api.get_paged(endpoint, params=params, page_size=page_size, merge=True)[endpoint])
+    return classify(*objects)
+
+
 def dump_to_file(data):
-    ts = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    filename = "healtharea_indicators_backup_{}.json".format(ts)
-    with open(filename, 'w') as out:
-        json.dump(data, out, indent=4)
+    filename = write_backup({'indicators': data}, 'healtharea_indicators')
     logger.info("Before state backed up to \033[1m{}\033[0m".format(filename))
 
 
@@ -69,9 +186,10 @@ def main():
     args = parse_args()
     setup_logger()
 
-    api = Api(server=args.server, username=args.username, password=args.password)
+    from .client import create_api
+    api = create_api(args, pool_size=args.workers)
 
-    if '.psi-mis.org' not in args.server and '.hnqis.org' not in args.server:
+    if '.psi-mis.org' not in api.base_url and '.hnqis.org' not in api.base_url:
         logger.warn("This script is intended only for *.psi-mis.org or *.hnqis.org")
         sys.exit(0)
 
@@ -79,83 +197,48 @@ def main():
     backup_indicators = []
     container = []
 
-    for ha in HEALTH_AREAS:
-
-        # VMMC splits do not have their own HA
-        if ha == 'VMMC':
-            p1 = {
-                'paging': False,
-                'filter': [
-                    'name:like:HNQIS - {}'.format(ha),
-                    'name:like$:count',
-                    'program.name:!like:v1'  # don't get v1 programIndicators
-                ],
-                'fields': '[id,name]'
-            }
-        else:
-            p1 = {
-                'paging': False,
-                'filter': [
-                    'name:like:HNQIS - {} count'.format(ha),
-                    'program.name:!like:v1'  # don't get v1 programIndicators
-                ],
-                'fields': '[id,name]'
-            }
-        data1 = api.get('programIndicators', params=p1).json()
-        pi_uids = [p['id'] for p in data1['programIndicators']]
-
-        p2 = {
-            'paging': False,
-            'filter': ['name:eq:HNQIS - {} count'.format(ha)],
-            'fields': ':owner'
-        }
-        data2 = api.get('indicators', params=p2).json()
-        backup_indicators.append(data2['indicators'])
-
-        if ha == 'VMMC':
-            p3 = {
-                'paging': False,
-                'filter': [
-                    'shortName:like: HNQIS {}'.format(ha),
-                    'name:!like:v1'
-                ],
-                'fields': 'id,name'
-            }
+    with phase('fetch'):
+        if args.sweep:
+            health_areas = fetch_health_areas_sweep(api)
         else:
-            p3 = {
-                'paging': False,
-                'filter': [
-                    'shortName:like: HNQIS {}'.format(ha),  # 2.30 would need to change filters
-                    'name:!like:v1'
-                ],
-                'fields': 'id,name'
-            }
-        data3 = api.get('programs', params=p3).json()
-        no_of_programs = len(data3['programs'])
+            health_areas = fetch_health_areas(api, args.workers)
+
+    for ha, programindicators, ha_indicators, programs in health_areas:
+        pi_uids = [p['id'] for p in programindicators]
+        backup_indicators.extend(ha_indicators)
+
+        no_of_programs = len(programs)
 
         if no_of_programs != len(pi_uids):
             print(u"\033[1mWarning\033[1m\033[0m - number of {} programs ({}) "
                   u"does not match number of 'count' programIndicators ({})!".format(ha, no_of_programs, len(pi_uids)))
-            print("\n".join([x['name'] for x in data3['programs']]))
+            print("\n".join([x['name'] for x in programs]))
 
-        if len(data2['indicators']) == 1:
-            i = data2['indicators'][0]
+        if len(ha_indicators) == 1:
+            # copy so the backup keeps the old numerator
+            i = dict(ha_indicators[0])
             i['numerator'] = create_numerator(pi_uids)
             container.append(i)
             print(u'  \033[1m{}\033[0m - Added {} programIndicators to numerator of indicator "{}"'.format(ha, len(pi_uids), i['name']))
 
-        elif len(data2['indicators']) > 1:
+        elif len(ha_indicators) > 1:
             print(u"\033[1mMore than one indicator found for health area {}\033[0m".format(ha))
         elif len(pi_uids) != 0:
             print(u"\033[1mNo indicator found for health area {}\033[0m".format(ha))
 
-    dump_to_file(backup_indicators)
     indicators['indicators'] = container
-
-    print(u"Posting updated programindicators to \033[1m{}\033[0m...".format(args.server))
-    time.sleep(3)
-    
-    api.post('metadata', params={'importMode': 'COMMIT', 'preheatCache': False}, data=indicators)
+    if args.plan:
+        plan = Plan(api, workers=args.workers)
+        plan.add(u"update {} indicators".format(len(container)), 'POST', 'metadata', 1,
+                 upload=len(json.dumps(indicators)))
+        plan.report()
+        return
+
+    with phase('backup'):
+        dump_to_file(backup_indicators)
+    print(u"Posting updated programindicators to \033[1m{}\033[0m...".format(api.base_url))
+    with phase('import'):
+        api.post('metadata', params={'importMode': 'COMMIT', 'preheatCache': False}, data=indicators)
 
 
 if __name__ == "__main__":
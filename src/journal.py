@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+from threading import Lock
+
+
+def journal_filename(source):
+    """e.g. /path/to/file.csv -> /path/to/file_journal.jsonl"""
+    return u"{}_journal.jsonl".format(os.path.splitext(source)[0])
+
+
+def load_journal(path):
+    """Return the set of entries in a journal file. A line cut off by a crash is ignored."""
+    applied = set()
+    if not os.path.exists(path):
+        return applied
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                applied.add(tuple(json.loads(line)))
+            except ValueError:
+                continue
+    return applied
+
+
+class Journal(object):
+    """Append-only log of applied entries (tuples of strings), one JSON line each, synced to disk
+    before the next row or batch is started. With `resume`, entries of a previous run are kept
+    and can be skipped - otherwise the journal starts empty. The file is opened on the first record,
+    so read-only runs (e.g. --plan) leave it alone."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resume = resume
+        self.applied = load_journal(path) if resume else set()
+        self._lock = Lock()
+        self._fp = None
+
+    def __contains__(self, entry):
+        return tuple(entry) in self.applied
+
+    def __len__(self):
+        return len(self.applied)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, *entries):
+        """Append entries of a committed row or batch and fsync them"""
+        with self._lock:
+            if self._fp is None:
+                self._fp = open(self.path, 'a' if self.resume else 'w')
+            for entry in entries:
+                self._fp.write(json.dumps(list(entry)) + '\n')
+                self.applied.add(tuple(entry))
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+
+    def pending(self, items, key):
+        """Items whose `key(item)` entry is not in the journal yet"""
+        return [item for item in items if key(item) not in self]
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
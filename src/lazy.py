@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""dhis2 names the commands use, importing dhis2 (and with it requests) only when they are first used.
+Loading a command and parsing its arguments (e.g. --help) stays fast."""
+
+
+class _Logger(object):
+    """Stand-in for dhis2.logger"""
+
+    def __getattr__(self, name):
+        from dhis2 import logger as dhis2_logger
+        return getattr(dhis2_logger, name)
+
+
+logger = _Logger()
+
+
+def setup_logger(*args, **kwargs):
+    from dhis2 import setup_logger as dhis2_setup_logger
+    return dhis2_setup_logger(*args, **kwargs)
+
+
+def load_csv(path, delimiter=','):
+    from dhis2 import load_csv as dhis2_load_csv
+    return dhis2_load_csv(path, delimiter=delimiter)
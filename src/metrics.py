@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PERCENTILES = (50, 90, 99)
+
+
+def add_metrics_arguments(parser):
+    """Add the --metrics and --trace arguments every hnqis-* command accepts"""
+    parser.add_argument('--metrics', dest='metrics_file', action='store', required=False,
+                        help="Write a JSON summary of requests, phases and memory of this run to this file")
+    parser.add_argument('--trace', dest='trace_file', action='store', required=False,
+                        help="Write a timeline of this run to this file (open in chrome://tracing)")
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def union_seconds(intervals):
+    """Seconds covered by (start, end) intervals, counting overlapping intervals once"""
+    total = 0.0
+    covered = None
+    for start, end in sorted(intervals):
+        if covered is None or start > covered:
+            total += end - start
+            covered = end
+        elif end > covered:
+            total += end - covered
+            covered = end
+    return total
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes, None where unknown"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Metrics(object):
+    """Timeline of a run: requests (recorded by the Client) and phases like CSV load or validation"""
+
+    def __init__(self):
+        self.started = time.time()
+        # (category, name, start, seconds, thread)
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add_span(self, category, name, start, seconds):
+        with self._lock:
+            self.spans.append((category, name, start, seconds, threading.current_thread().ident))
+
+    @contextmanager
+    def phase(self, name):
+        """Record the time spent in a block of code, e.g. `with phase('validate'):`"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span('phase', name, start, time.time() - start)
+
+    def intervals(self, category):
+        return [(start, start + seconds) for c, _, start, seconds, _ in self.spans if c == category]
+
+    def summary(self, api):
+        """Dict with requests, latency percentiles and bytes per endpoint, phase timings and peak memory.
+        `network_seconds` of a phase is the time at least one request was running during it -
+        the rest of a phase was spent in the client."""
+        wall = time.time() - self.started
+        requests = {}
+        for key in sorted(api.timings):
+            seconds = api.timings[key]
+            sent, received = api.transferred[key]
+            latency = {'p{}'.format(p): percentile(seconds, p) for p in PERCENTILES}
+            latency['mean'] = sum(seconds) / len(seconds)
+            latency['max'] = max(seconds)
+            requests[key] = {'count': len(seconds), 'sent': sent, 'received': received, 'latency': latency}
+
+        network = self.intervals('network')
+        phases = {}
+        for category, name, start, seconds, _ in self.spans:
+            if category != 'phase':
+                continue
+            end = start + seconds
+            overlap = union_seconds([(max(s, start), min(e, end)) for s, e in network if s < end and e > start])
+            totals = phases.setdefault(name, {'count': 0, 'seconds': 0.0, 'network_seconds': 0.0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['network_seconds'] += overlap
+
+        network_seconds = union_seconds(network)
+        return {
+            'command': os.path.basename(sys.argv[0]),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': wall,
+            'network_seconds': network_seconds,
+            'client_seconds': max(0.0, wall - network_seconds),
+            'requests': requests,
+            'total': {
+                'count': sum(r['count'] for r in requests.values()),
+                'sent': sum(r['sent'] for r in requests.values()),
+                'received': sum(r['received'] for r in requests.values())
+            },
+            'phases': phases,
+            'peak_rss': peak_rss()
+        }
+
+    def trace(self):
+        """Spans in the Chrome trace event format"""
+        pid = os.getpid()
+        events = [{
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start - self.started) * 1e6),
+            'dur': int(seconds * 1e6),
+            'pid': pid,
+            'tid': thread
+        } for category, name, start, seconds, thread in self.spans]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, api, metrics_file=None, trace_file=None):
+        if metrics_file:
+            with open(metrics_file, 'w') as f:
+                json.dump(self.summary(api), f, indent=2, sort_keys=True)
+        if trace_file:
+            with open(trace_file, 'w') as f:
+                json.dump(self.trace(), f)
+
+
+METRICS = Metrics()
+phase = METRICS.phase
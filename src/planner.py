@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+DEFAULT_LATENCY = 0.5
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return u"{:.1f} {}".format(n, unit) if unit != 'B' else u"{} B".format(int(n))
+        n /= 1024.0
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return u"{}h {:02d}m {:02d}s".format(hours, minutes, seconds)
+
+
+class Plan(object):
+    """Estimate of the requests a run will make, for the --plan mode of hnqis-* commands.
+    Read requests already made while planning (recorded by the Client) are part of the run too."""
+
+    def __init__(self, api, workers=1):
+        self.api = api
+        self.workers = max(1, workers)
+        self.steps = []
+        self.notes = []
+
+    def add(self, description, method, endpoint, count, upload=0, download=0, concurrent=False):
+        """Add an estimated step: `count` requests with `upload`/`download` bytes in total.
+        Concurrent steps are spread over the workers."""
+        self.steps.append((description, method, endpoint, int(count), int(upload), int(download), concurrent))
+
+    def note(self, text):
+        """Add a line to the report, e.g. about a part of the run that can't be estimated"""
+        self.notes.append(text)
+
+    @property
+    def latency(self):
+        """Mean latency of the requests made so far"""
+        seconds = [t for timings in self.api.timings.values() for t in timings]
+        return sum(seconds) / len(seconds) if seconds else DEFAULT_LATENCY
+
+    def rows(self):
+        for key in sorted(self.api.timings):
+            method, endpoint = key.split(' ', 1)
+            sent, received = self.api.transferred[key]
+            yield u"done while planning", method, endpoint, len(self.api.timings[key]), sent, received, False
+        for step in self.steps:
+            yield step
+
+    def report(self):
+        latency = self.latency
+        requests = upload = download = 0
+        runtime = 0.0
+        print(u"\033[1mPlan\033[0m (no changes made):")
+        for description, method, endpoint, count, up, down, concurrent in self.rows():
+            print(u"  {:<7}{:<32}{:>9} requests  up {:>10}  down {:>10}  {}".format(
+                method, endpoint, count, format_bytes(up), format_bytes(down), description))
+            requests += count
+            upload += up
+            download += down
+            runtime += count * latency / (self.workers if concurrent else 1)
+        print(u"\033[1mTotal\033[0m: {} requests, up {}, down {}, estimated runtime {} "
+              u"(mean latency {:.3f}s, {} worker(s))".format(requests, format_bytes(upload), format_bytes(download),
+                                                              format_seconds(runtime), latency, self.workers))
+        for text in self.notes:
+            print(u"\033[1mNote\033[0m: {}".format(text))
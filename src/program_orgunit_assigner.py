@@ -3,14 +3,18 @@
 
 import argparse
 import json
-from copy import deepcopy
 
-from dhis2 import Api, setup_logger, logger, load_csv, is_valid_uid
-from six import iteritems
+from .backup import write_backup
+from .cache import Cache
+from .lazy import load_csv, logger, setup_logger
+from .metrics import add_metrics_arguments, phase
+from .planner import Plan
+from .utils import chunk, import_report_errors, positive_int, post_metadata
+from .validation import check, report_filename, validate_rows
 
 
 def parse_args():
-    usage = "hnqis-program-orgunit [-s] [-u] [-p] -c [-a]" \
+    usage = "hnqis-program-orgunit [-s] [-u] [-p] -c [-a] [--chunk] [--delta] [--dry-run] [--no-cache] [--plan] [--metrics] [--trace]" \
             "\n\n\033[1mExample:\033[0m " \
             "\nhnqis-program-orgunit -s=data.psi-mis.org -u=admin -p=district -c=/path/to/file.csv -a" \
             "\n\n\033[1mCSV file structure:\033[0m         " \
@@ -24,37 +28,29 @@ def parse_args():
     parser.add_argument('-c', dest='source_csv', action='store', help="CSV file path", required=True)
     parser.add_argument('-a', dest='append_orgunits', action='store_true', help="Append Orgunit to existing",
                         default=False, required=False)
+    parser.add_argument('--chunk', dest='chunk_size', action='store', type=positive_int, required=False,
+                        help="Import programs in chunks of this size instead of all at once, e.g. --chunk=10")
+    parser.add_argument('--delta', dest='delta', action='store_true', default=False, required=False,
+                        help="Only send added/removed OrgUnits via programs/<uid>/organisationUnits")
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False, required=False,
+                        help="Print OrgUnits that would be added/removed without changing anything")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', default=False, required=False,
+                        help="Do not use the local metadata cache")
+    parser.add_argument('--plan', dest='plan', action='store_true', default=False, required=False,
+                        help="Only estimate requests, transferred bytes and runtime of this run (read-only)")
     parser.add_argument('-u', dest='username', action='store', help="DHIS2 username")
     parser.add_argument('-p', dest='password', action='store', help="DHIS2 password")
     parser.add_argument('-d', dest='debug', action='store_true', default=False, required=False,
                         help="Writes more info in log file")
 
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
-def validate_csv(data):
-    if not data:
-        raise ValueError(" CSV not valid (empty?)")
-
-    if not data[0].get('orgunit', None):
-        raise ValueError(u"+++ CSV not valid: CSV must have 'orgunit' header")
-
-    if len(data[0]) <= 1:
-        raise ValueError(u"+++ No programs found in CSV")
-
-    orgunit_uids = [ou['orgunit'] for ou in data]
-    if len(orgunit_uids) != len(set(orgunit_uids)):
-        raise ValueError(u"Duplicate Orgunits (rows) found in the CSV")
-
-    for ou in orgunit_uids:
-        if not is_valid_uid(ou):
-            raise ValueError(u"OrgUnit {} is not a valid UID in the CSV".format(ou))
-
-    for row in data:
-        for p in row.keys():
-            if not is_valid_uid(p) and p != 'orgunit':
-                raise ValueError(u"Program {} is not a valid UID in the CSV".format(p))
-    return True
+def validate_csv(data, report=None):
+    """Validate rows (any iterable, e.g. load_csv) in one pass, optionally writing all errors to a CSV report"""
+    errors = validate_rows(data, required=['orgunit'], key='orgunit', uid_headers=True)
+    return check(errors, report)
 
 
 def get_program_orgunit_map(data):
@@ -63,7 +59,7 @@ def get_program_orgunit_map(data):
     #  "programuid":["orgunitid1", ...],
     # }
     for row in data:
-        for k, v in iteritems(row):
+        for k, v in row.items():
             if k != 'orgunit' and v.lower().strip() == 'yes':
                 if k not in program_orgunit_map:
                     program_orgunit_map[k] = list()
@@ -72,14 +68,12 @@ def get_program_orgunit_map(data):
 
 
 def set_program_orgunits(program, orgunit_list, append_orgunits):
-    program_copy = deepcopy(program)
+    # only organisationUnits changes, so a shallow copy is enough
+    program_copy = dict(program)
     if append_orgunits:
-        tmp = program_copy.get('organisationUnits', None)
-        if tmp is None:
-            tmp = []
-        else:
-            # removing orgunits that will be added again later to avoid duplicates
-            tmp[:] = [p for p in tmp if p['id'] not in orgunit_list]
+        # removing orgunits that will be added again later to avoid duplicates
+        new_orgunits = set(orgunit_list)
+        tmp = [p for p in program.get('organisationUnits') or [] if p['id'] not in new_orgunits]
     else:
         tmp = []
     for ou in orgunit_list:
@@ -88,14 +82,108 @@ def set_program_orgunits(program, orgunit_list, append_orgunits):
     return program_copy
 
 
+def diff_program_orgunits(current, orgunit_list, append_orgunits):
+    """Return (additions, deletions) to get from the `current` orgunit UIDs to the ones set_program_orgunits sets"""
+    current_set = set(current)
+    additions = [ou for ou in orgunit_list if ou not in current_set]
+    if append_orgunits:
+        deletions = []
+    else:
+        new_orgunits = set(orgunit_list)
+        deletions = [ou for ou in current if ou not in new_orgunits]
+    return additions, deletions
+
+
+def assign_delta(api, program_orgunit_map, append_orgunits, dry_run, plan=None):
+    """Add/remove only the OrgUnits that differ from the server via the program's organisationUnits collection.
+    The programs are backed up before the first change. A program that fails is logged and skipped.
+    With a `plan`, the requests are added to the plan instead of being sent."""
+    from dhis2 import RequestException
+    # all owner fields, so hnqis-restore can import the backup
+    programs = fetch_programs(api, program_orgunit_map)
+    if plan is None and not dry_run:
+        with phase('backup'):
+            backup = write_backup({'programs': programs}, 'programs')
+        logger.info(u"Before state backed up to \033[1m{}\033[0m".format(backup))
+    for program in programs:
+        current = [ou['id'] for ou in program.get('organisationUnits', [])]
+        additions, deletions = diff_program_orgunits(current, program_orgunit_map[program['id']], append_orgunits)
+        print(u"Program \033[1m{}\033[0m ({}): +{} -{} OrgUnits".format(program['name'], program['id'],
+                                                                       len(additions), len(deletions)))
+        endpoint = 'programs/{}/organisationUnits'.format(program['id'])
+        if plan is not None:
+            for method, orgunits in (('POST', additions), ('DELETE', deletions)):
+                if orgunits:
+                    payload = {'identifiableObjects': [{'id': ou} for ou in orgunits]}
+                    plan.add(program['name'], method, endpoint, 1, upload=len(json.dumps(payload)))
+            continue
+        if dry_run:
+            for ou in additions:
+                print(u"  + {}".format(ou))
+            for ou in deletions:
+                print(u"  - {}".format(ou))
+            continue
+        added = 0
+        try:
+            if additions:
+                api.post(endpoint, data={'identifiableObjects': [{'id': ou} for ou in additions]})
+                added = len(additions)
+            if deletions:
+                api.delete(endpoint, data={'identifiableObjects': [{'id': ou} for ou in deletions]})
+        except RequestException as e:
+            # OrgUnits are added before others are removed
+            done = u" - {} OrgUnits were added, none removed".format(added) if added else u""
+            logger.error(u"Program {} ({}) not updated{}: {}".format(program['name'], program['id'], done, e))
+        else:
+            logger.info(u"Program {} ({}) updated: +{} -{} OrgUnits".format(program['name'], program['id'],
+                                                                           len(additions), len(deletions)))
+
+
+def fetch_programs(api, program_orgunit_map):
+    """GET the programs of program_orgunit_map with all owner fields in one request,
+    logging programs the server did not return"""
+    params_get = {
+        'fields': ':owner',
+        'filter': 'id:in:[{}]'.format(','.join(program_orgunit_map)),
+        'paging': False
+    }
+    programs = api.get('programs', params=params_get).json()['programs']
+    found = set(p['id'] for p in programs)
+    for uid in program_orgunit_map:
+        if uid not in found:
+            logger.error(u"Program {} not found - its OrgUnits are not assigned".format(uid))
+    return programs
+
+
+def import_programs(api, programs, chunk_size=None):
+    """POST programs to /api/metadata in chunks of chunk_size (all at once by default),
+    return {program UID: [error messages]} of programs that were not imported"""
+    params_post = {
+        "mergeMode": "REPLACE",
+        "strategy": "UPDATE"
+    }
+    errors = {}
+    for programs_chunk in chunk(programs, chunk_size or len(programs)):
+        report = post_metadata(api, {'programs': programs_chunk}, params_post)
+        errors.update(import_report_errors(report, programs_chunk))
+        if report.get('response', report).get('status') == 'ERROR':
+            # the import is atomic: nothing of this chunk was imported
+            for program in programs_chunk:
+                errors.setdefault(program['id'], [u"Import of chunk failed"])
+    return errors
+
+
 def main():
     args = parse_args()
     setup_logger()
 
-    api = Api(server=args.server, username=args.username, password=args.password)
+    from .client import create_api
+    api = create_api(args)
 
-    data = list(load_csv(args.source_csv))
-    validate_csv(data)
+    with phase('validate'):
+        validate_csv(load_csv(args.source_csv), report=report_filename(args.source_csv))
+    with phase('load_csv'):
+        data = list(load_csv(args.source_csv))
 
     programs_csv = [h.strip() for h in data[0] if h != 'orgunit']
     if not programs_csv:
@@ -104,36 +192,62 @@ def main():
         'fields': 'id',
         'paging': False
     }
-    programs_server = [p['id'] for p in api.get('programs', params=params_get).json()['programs']]
+    cache = Cache(enabled=not args.no_cache)
+    programs_server = [p['id'] for p in cache.get(api, 'programs', params=params_get)['programs']]
     for p in programs_csv:
         if p not in programs_server:
             logger.error(u"Program {0} is not a valid program: {1}/programs/{0}.json".format(p, api.api_url))
 
     program_orgunit_map = get_program_orgunit_map(data)
-    metadata_payload = []
-    final = {}
-    for program_uid, orgunit_list in iteritems(program_orgunit_map):
-        params_get = {'fields': ':owner'}
-        program = api.get('programs/{}'.format(program_uid), params=params_get).json()
-        updated = set_program_orgunits(program, orgunit_list, args.append_orgunits)
-        metadata_payload.append(updated)
-
-        with open('backup_{}.json'.format(program_uid), 'w') as f:
-            json.dump(program, f, indent=4)
-
-        print(
-            u"[{}] - Assigning \033[1m{} (total: {})\033[0m "
-            u"OrgUnits to Program \033[1m{}\033[0m...".format(args.server,
-                                                              len(orgunit_list),
-                                                              len(program['organisationUnits']),
-                                                              program['name']))
-
-        final['programs'] = [updated]
-        params_post = {
-            "mergeMode": "REPLACE",
-            "strategy": "UPDATE"
-        }
-        api.post(endpoint='metadata', params=params_post, data=final)
+    if not program_orgunit_map:
+        logger.warn(u"No OrgUnits to assign")
+        return
+    plan = Plan(api) if args.plan else None
+    if args.delta or args.dry_run:
+        with phase('delta'):
+            assign_delta(api, program_orgunit_map, args.append_orgunits, args.dry_run, plan)
+        if plan:
+            plan.report()
+        return
+    with phase('fetch'):
+        programs = fetch_programs(api, program_orgunit_map)
+    with phase('transform'):
+        metadata_payload = []
+        for program in programs:
+            orgunit_list = program_orgunit_map[program['id']]
+            updated = set_program_orgunits(program, orgunit_list, args.append_orgunits)
+            metadata_payload.append(updated)
+
+            print(
+                u"[{}] - Assigning \033[1m{} (total: {})\033[0m "
+                u"OrgUnits to Program \033[1m{}\033[0m...".format(args.server,
+                                                                  len(orgunit_list),
+                                                                  len(program['organisationUnits']),
+                                                                  program['name']))
+
+    if not metadata_payload:
+        logger.warning(u"No programs to update")
+        return
+    if plan:
+        for programs_chunk in chunk(metadata_payload, args.chunk_size or len(metadata_payload)):
+            plan.add(u"import {} programs".format(len(programs_chunk)), 'POST', 'metadata', 1,
+                     upload=len(json.dumps({'programs': programs_chunk})))
+        plan.report()
+        return
+
+    with phase('backup'):
+        backup = write_backup({'programs': programs}, 'programs')
+    logger.info(u"Before state backed up to \033[1m{}\033[0m".format(backup))
+    with phase('import'):
+        errors = import_programs(api, metadata_payload, args.chunk_size)
+
+    for program in metadata_payload:
+        if program['id'] in errors:
+            logger.error(u"Program {} ({}) not updated: {}".format(program['name'], program['id'],
+                                                                   ' '.join(errors[program['id']])))
+        else:
+            logger.info(u"Program {} ({}) updated: {} OrgUnits".format(program['name'], program['id'],
+                                                                       len(program['organisationUnits'])))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+
+from .backup import read_backup
+from .lazy import logger, setup_logger
+from .metrics import add_metrics_arguments, phase
+from .utils import import_report_errors, post_metadata
+
+
+def parse_args():
+    usage = "hnqis-restore [-s] [-u] [-p] -f [--metrics] [--trace]" \
+            "\n\n\033[1mExample:\033[0m " \
+            "\nhnqis-restore -s=data.psi-mis.org -u=admin -p=district -f=backups/programs_2018-05-01-10-00-00_0a1b2c3d4e5f.json.gz"
+    parser = argparse.ArgumentParser(
+        description="Restore a backup written by hnqis-* commands via /api/metadata", usage=usage)
+    parser.add_argument('-s', dest='server', action='store',
+                        help="DHIS2 server URL without /api/ e.g. -s=play.dhis2.org/demo")
+    parser.add_argument('-f', dest='backup_file', action='store', help="Backup file (.json.gz)", required=True)
+    parser.add_argument('-u', dest='username', action='store', help="DHIS2 username")
+    parser.add_argument('-p', dest='password', action='store', help="DHIS2 password")
+    parser.add_argument('-d', dest='debug', action='store_true', default=False, required=False,
+                        help="Writes more info in log file")
+
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logger()
+
+    with phase('read_backup'):
+        data = read_backup(args.backup_file)
+    from .client import create_api
+    api = create_api(args)
+
+    logger.info(u"[{}] - Restoring {}...".format(api.base_url, ', '.join(
+        u"{} {}".format(len(v), k) for k, v in data.items() if isinstance(v, list))))
+    params_post = {
+        'importStrategy': 'CREATE_AND_UPDATE',
+        'mergeMode': 'REPLACE'
+    }
+    with phase('import'):
+        report = post_metadata(api, data, params_post)
+    errors = import_report_errors(report)
+    for uid, messages in errors.items():
+        logger.error(u"{} not restored: {}".format(uid, ' '.join(messages)))
+    logger.info(u"Import status: {}".format(report.get('response', report).get('status')))
+
+
+if __name__ == "__main__":
+    main()
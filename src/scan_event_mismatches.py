@@ -2,16 +2,35 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
+import os
+from multiprocessing.pool import ThreadPool
 
-from dhis2 import Api, setup_logger, logger
+from .cache import Cache
+from .journal import Journal, journal_filename
+from .lazy import logger, setup_logger
+from .metrics import add_metrics_arguments, phase
+from .planner import Plan
+from .utils import atomic_open, chunk, failed_import_references, positive_int
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 THRESHOLD = 1
 ORDER_FORWARD = 'FEkGksxhOpH'
 OVERALL_SCORE = 'Y8Nmpp7RhXw'
+PAGE_SIZE = 1000
+FIX_BATCH_SIZE = 200
+MERGE_DATAVALUES_VERSION = 32
+JOURNAL = 'hnqis-scan-mismatches_journal.jsonl'
+# event columns of an /api/events/query grid used by the scan and the fix - data elements are extra columns
+EVENT_COLUMNS = ('event', 'program', 'orgUnit', 'eventDate', 'lastUpdated', 'status')
 
 
 def parse_args():
-    usage = "hnqis-scan-mismatches [-s] [-u] [-p] -x" \
+    usage = "hnqis-scan-mismatches [-s] [-u] [-p] [-x] [-b] [-n] [--parallel] [--state] [--full] [--no-cache] [--plan] [--resume] [--metrics] [--trace]" \
             "\n\n\033[1mExample:\033[0m " \
             "\nhnqis-scan-mismatches -s=data.psi-mis.org -u=admin -p=district -x"
     parser = argparse.ArgumentParser(
@@ -20,11 +39,29 @@ def parse_args():
                         help="DHIS2 server URL without /api/ e.g. -s=play.dhis2.org/demo")
     parser.add_argument('-x', dest='fix_values', action='store_true', default=False, required=False,
                         help="Fix events by overwriting _Overall Score with 0CS-100 score + resetting _Order Forward to 9999")
+    parser.add_argument('-b', dest='batch_size', action='store', type=positive_int, default=FIX_BATCH_SIZE, required=False,
+                        help="Number of events to fix per bulk import, default: {}".format(FIX_BATCH_SIZE))
+    parser.add_argument('-n', dest='page_size', action='store', type=positive_int, default=PAGE_SIZE, required=False,
+                        help="Number of events to download per page, default: {}".format(PAGE_SIZE))
+    parser.add_argument('--parallel', dest='parallel', action='store', type=positive_int, default=1, required=False,
+                        help="Number of programs to scan at the same time, e.g. --parallel=4")
+    parser.add_argument('--state', dest='state_file', action='store', required=False,
+                        help="Incremental mode: only scan events changed since the last run recorded in this JSON file")
+    parser.add_argument('--full', dest='full_scan', action='store_true', default=False, required=False,
+                        help="Force a complete rescan in incremental mode")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', default=False, required=False,
+                        help="Do not use the local metadata cache")
+    parser.add_argument('--plan', dest='plan', action='store_true', default=False, required=False,
+                        help="Only estimate requests, transferred bytes and runtime of this run (read-only)")
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False, required=False,
+                        help="With -x: skip events already fixed by a previous run (recorded in {} "
+                             "or <state>_journal.jsonl)".format(JOURNAL))
     parser.add_argument('-u', dest='username', action='store', help="DHIS2 username")
     parser.add_argument('-p', dest='password', action='store', help="DHIS2 password")
     parser.add_argument('-d', dest='debug', action='store_true', default=False, required=False,
                         help="Writes more info in log file")
 
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
@@ -39,57 +76,326 @@ def fix_event(event, root_compscores):
     return event
 
 
-def analyze_event(program, event, root_compscores):
-    """Analyze if event needs to be fixed"""
-    x = [dv['value'] for dv in event['dataValues'] if dv['dataElement'] == OVERALL_SCORE]
-    y = [dv['value'] for dv in event['dataValues'] if dv['dataElement'] in root_compscores]
-    if x and y:
-        n1 = float(x[0])
-        n2 = float(y[0])
-        diff = abs(n1-n2)
-        if diff > THRESHOLD:
-            print(u"{},{},{},{},{},{},{}".format(event['eventDate'], program['id'], program['name'], event['event'], n1, n2, diff))
-            return event['event']
+def minimal_event(event):
+    """Reduce a fixed event to what is needed to update it: _Overall Score and _Order Forward"""
+    payload = {k: event[k] for k in ('event', 'program', 'orgUnit', 'eventDate', 'status') if k in event}
+    payload['dataValues'] = [dv for dv in event['dataValues'] if dv['dataElement'] in (OVERALL_SCORE, ORDER_FORWARD)]
+    return payload
+
+
+def import_events(api, events):
+    """POST events to /api/events with strategy UPDATE, merging the posted data values into the existing ones.
+    Returns the UIDs of events that failed."""
+    from dhis2 import RequestException
+    params = {
+        'strategy': 'UPDATE',
+        'mergeDataValues': True
+    }
+    try:
+        summaries = api.post('events', params=params, data={'events': events}).json()
+    except RequestException as e:
+        # DHIS2 answers with 409 if any event was rejected - the import summaries are in the body
+        try:
+            summaries = json.loads(e.description)
+        except ValueError:
+            raise e
+    return failed_import_references(summaries, events)
+
+
+def put_datavalues(api, event):
+    """Update every data value of an event on its own via PUT events/{uid}/{dataElement}"""
+    for dv in event['dataValues']:
+        payload = dict(event, dataValues=[dv])
+        api.put('events/{}/{}'.format(event['event'], dv['dataElement']), data=payload)
+
+
+def fix_events(api, uids, root_compscores, batch_size=FIX_BATCH_SIZE, journal=None):
+    """Fix events in bulk imports of `batch_size` events, sending only the fixed data values.
+    Servers without `mergeDataValues` and events failing the bulk import are updated value by value.
+    Fixed events of every batch are recorded in the `journal`, events already in it are skipped."""
+    from dhis2 import RequestException
+    data_elements = set(root_compscores) | {OVERALL_SCORE, ORDER_FORWARD}
+    if journal is not None:
+        pending = journal.pending(uids, lambda uid: (uid,))
+        if len(pending) < len(uids):
+            logger.info(u"Resuming - skipping {} events already fixed".format(len(uids) - len(pending)))
+        uids = pending
+    # older servers drop data values missing from an imported event - so may servers of an unknown version
+    bulk = (api.version_int or 0) >= MERGE_DATAVALUES_VERSION
+    done = 0
+    for batch in chunk(uids, batch_size):
+        params = {
+            'event': ';'.join(batch),
+            'dataElement': ','.join(sorted(data_elements)),
+            'skipPaging': True
+        }
+        events = grid_events(api.get('events/query', params=params).json(), data_elements)
+        fixed = {}
+        for e in events:
+            fixed[e['event']] = minimal_event(fix_event(e, root_compscores))
+
+        failed = import_events(api, list(fixed.values())) if bulk else list(fixed)
+        retried = []
+        unknown = [uid for uid in failed if uid not in fixed]
+        for uid in failed:
+            if uid not in fixed:
+                logger.error(u"Bulk import failed for an event not in this batch: {} - skipping".format(uid))
+                continue
+            if bulk:
+                logger.warn(u"Bulk import failed for event {} - retrying...".format(uid))
+            try:
+                put_datavalues(api, fixed[uid])
+            except RequestException as e:
+                logger.error(u"failed: {} {}".format(uid, e))
+                del fixed[uid]
+            else:
+                retried.append(uid)
+        # which events of the batch failed is unknown - only journal those fixed one by one
+        applied = retried if unknown else list(fixed)
+        if journal is not None and applied:
+            journal.record(*[(uid,) for uid in applied])
+        done += len(batch)
+        logger.info(u"[{}/{}] Pushed {} events...".format(done, len(uids), len(fixed)))
+
+
+def iso_date(value):
+    """Grid dates may be formatted like 2018-05-01 00:00:00.0 - return them like the events API does"""
+    if len(value) > 10 and value[10] == ' ':
+        return value[:10] + 'T' + value[11:]
+    return value
+
+
+def grid_events(grid, data_elements):
+    """Turn an /api/events/query grid into events with EVENT_COLUMNS and the `dataValues` of `data_elements`"""
+    names = [header['name'] for header in grid['headers']]
+    events = []
+    for row in grid.get('rows', []):
+        cells = dict(zip(names, row))
+        event = {name: cells[name] for name in EVENT_COLUMNS if cells.get(name)}
+        for name in ('eventDate', 'lastUpdated'):
+            if name in event:
+                event[name] = iso_date(event[name])
+        event['dataValues'] = [{'dataElement': de, 'value': cells[de]} for de in sorted(data_elements) if cells.get(de)]
+        events.append(event)
+    return events
+
+
+def iter_pages(api, program_uid, data_elements, page_size=PAGE_SIZE, since=None):
+    """Yield pages (lists) of events of a program with only the data values of `data_elements`:
+    /api/events/query returns just the requested data element columns instead of every data value.
+    If `since` is set, only events updated at or after this timestamp are returned."""
+    params = {
+        'program': program_uid,
+        'dataElement': ','.join(sorted(data_elements)),
+        'pageSize': page_size
+    }
+    if since:
+        params['lastUpdatedStartDate'] = since
+    page = 1
+    while True:
+        params['page'] = page
+        events = grid_events(api.get('events/query', params=params).json(), data_elements)
+        if events:
+            yield events
+        if len(events) < page_size:
+            return
+        page += 1
+
+
+def analyze_page(program, events, root_compscores, engine=None):
+    """Return CSV rows (eventDate, program UID, program name, event UID, _Overall Score, 0CS-100, diff)
+    of the events of a page whose _Overall Score differs from their 0CS-100 score by more than THRESHOLD.
+    Scores are collected into columns in one pass per event and compared for the whole page at once,
+    with NumPy if installed (engine='numpy') or in pure Python (engine='python')."""
+    if engine is None:
+        engine = 'numpy' if numpy is not None else 'python'
+    if not isinstance(root_compscores, frozenset):
+        root_compscores = frozenset(root_compscores)
+
+    uids, dates, overall_scores, compscores = [], [], [], []
+    for event in events:
+        n1 = n2 = None
+        for dv in event['dataValues']:
+            if dv['dataElement'] == OVERALL_SCORE:
+                if n1 is None:
+                    n1 = dv['value']
+            elif n2 is None and dv['dataElement'] in root_compscores:
+                n2 = dv['value']
+        if n1 is not None and n2 is not None:
+            uids.append(event['event'])
+            dates.append(event['eventDate'])
+            overall_scores.append(float(n1))
+            compscores.append(float(n2))
+
+    if not uids:
+        return []
+    if engine == 'numpy':
+        diffs = numpy.abs(numpy.array(overall_scores) - numpy.array(compscores))
+        indexes = numpy.nonzero(diffs > THRESHOLD)[0].tolist()
+        diffs = diffs.tolist()
+    else:
+        diffs = [abs(n1 - n2) for n1, n2 in zip(overall_scores, compscores)]
+        indexes = [i for i, diff in enumerate(diffs) if diff > THRESHOLD]
+    return [(dates[i], program['id'], program['name'], uids[i], overall_scores[i], compscores[i], diffs[i])
+            for i in indexes]
+
+
+def print_row(row):
+    print(u"{},{},{},{},{},{},{}".format(*row))
+
+
+def scan_program(api, program, root_compscores, data_elements, page_size=PAGE_SIZE, since=None):
+    """Scan the events of a program (updated since `since`, if set).
+    Returns the mismatch rows sorted by eventDate and event UID, the UIDs of all scanned events
+    (None for a full scan) and the highest lastUpdated timestamp seen."""
+    rows = []
+    changed = set() if since else None
+    watermark = since
+    root_compscores = frozenset(root_compscores)
+    for page in iter_pages(api, program['id'], data_elements, page_size, since):
+        with phase('analyze'):
+            rows.extend(analyze_page(program, page, root_compscores))
+        for event in page:
+            if changed is not None:
+                changed.add(event['event'])
+            if event.get('lastUpdated') and (not watermark or event['lastUpdated'] > watermark):
+                watermark = event['lastUpdated']
+    return sorted(rows, key=lambda r: (r[0], r[3])), changed, watermark
+
+
+def load_state(filename):
+    """Load per-program lastUpdated watermarks and the mismatch ledger"""
+    if not os.path.exists(filename):
+        return {'programs': {}, 'mismatches': {}}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_state(filename, state):
+    """Write the state to a temporary file that replaces `filename`, so an interrupted run keeps the last state"""
+    with atomic_open(filename) as f:
+        json.dump(state, f)
+
+
+def merge_ledger(ledger, program_uid, rows, changed):
+    """Replace the ledger entries of a program (full scan) or of the rescanned events with new rows"""
+    if changed is None:
+        stale = [uid for uid, row in ledger.items() if row[1] == program_uid]
+    else:
+        stale = [uid for uid in changed if uid in ledger]
+    for uid in stale:
+        del ledger[uid]
+    for row in rows:
+        ledger[row[3]] = list(row)
+
+
+def plan_run(api, args, programs, data_elements, since, mismatches=None):
+    """Estimate the scan from the number of events and the size of one event row per program.
+    The fix (-x) is estimated from `mismatches`, the event UIDs found by the last scan (--state)."""
+    plan = Plan(api, workers=args.parallel)
+    sizes = []
+    for program in programs:
+        params = {
+            'program': program['id'],
+            'dataElement': ','.join(sorted(data_elements)),
+            'pageSize': 1,
+            'page': 1,
+            'totalPages': True
+        }
+        if since(program):
+            params['lastUpdatedStartDate'] = since(program)
+        grid = api.get('events/query', params=params).json()
+        total = (grid.get('metaData') or {}).get('pager', {}).get('total', 0)
+        size = len(json.dumps(grid['rows'][0])) if grid.get('rows') else 0
+        if size:
+            sizes.append(size)
+        plan.add(program['name'], 'GET', 'events/query', -(-total // args.page_size), download=total * size,
+                 concurrent=True)
+    if args.fix_values and mismatches is None:
+        plan.note(u"-x is not estimated: mismatched events are only known after a scan - plan with --state")
+    elif args.fix_values and not mismatches:
+        plan.note(u"-x: no mismatched events to fix in the last scan")
+    elif args.fix_values:
+        n = len(mismatches)
+        size = sum(sizes) // len(sizes) if sizes else 0
+        batches = -(-n // args.batch_size)
+        plan.add(u"-x: fetch {} mismatched events".format(n), 'GET', 'events/query', batches, download=n * size)
+        if (api.version_int or 0) >= MERGE_DATAVALUES_VERSION:
+            plan.add(u"-x: import fixed events", 'POST', 'events', batches, upload=n * size)
+        else:
+            # _Overall Score and _Order Forward, one by one
+            plan.add(u"-x: update data values", 'PUT', 'events/<uid>/<dataElement>', 2 * n, upload=2 * n * size)
+    return plan
 
 
 def main():
     args = parse_args()
     setup_logger()
 
-    api = Api(server=args.server, username=args.username, password=args.password)
+    from .client import create_api
+    api = create_api(args, pool_size=args.parallel)
     p = {
         'paging': False,
         'filter': 'name:like:HNQIS',
         'fields': 'id,name'
     }
-    programs = api.get('programs', params=p)
-    print("event_date,program,name,event,_OverallScore,0CS-100,diff")
-    fix_them = []
+    cache = Cache(enabled=not args.no_cache)
+    programs = cache.get(api, 'programs', params=p)
 
     csparams = {
         'filter': ['shortName:like:.0CS-100', 'name:!ilike:_DEL'],
         'paging': False,
         'fields': 'id'
     }
-    root_compscores = [x['id'] for x in api.get('dataElements', params=csparams).json()['dataElements']]
+    root_compscores = [x['id'] for x in cache.get(api, 'dataElements', params=csparams)['dataElements']]
 
-    for p in programs['programs']:
-        params = {
-            'program': p['id'],
-            'skipPaging': True,
-            'fields': '[*]'
-        }
-        events = api.get('events', params=params).json()
-        for event in events['events']:
-            if analyze_event(p, event, root_compscores):
-                fix_them.append(event)
+    data_elements = set(root_compscores) | {OVERALL_SCORE, ORDER_FORWARD}
+
+    state = load_state(args.state_file) if args.state_file else None
+
+    def since(program):
+        if state and not args.full_scan:
+            return state['programs'].get(program['id'])
+
+    if args.plan:
+        mismatches = None
+        if state:
+            journal = Journal(journal_filename(args.state_file), resume=args.resume)
+            mismatches = journal.pending(sorted(state['mismatches']), lambda uid: (uid,))
+        plan_run(api, args, programs['programs'], data_elements, since, mismatches).report()
+        return
+
+    def scan(program):
+        return program, scan_program(api, program, root_compscores, data_elements, args.page_size, since(program))
+
+    print("event_date,program,name,event,_OverallScore,0CS-100,diff")
+    fix_them = []
+
+    # programs are scanned concurrently but rows are printed in program order, same as a serial run
+    with phase('scan'):
+        pool = ThreadPool(max(1, args.parallel))
+        try:
+            for program, (rows, changed, watermark) in pool.imap(scan, programs['programs']):
+                if state:
+                    merge_ledger(state['mismatches'], program['id'], rows, changed)
+                    if watermark:
+                        state['programs'][program['id']] = watermark
+                    rows = sorted([r for r in state['mismatches'].values() if r[1] == program['id']],
+                                  key=lambda r: (r[0], r[3]))
+                for row in rows:
+                    print_row(row)
+                    fix_them.append(row[3])
+        finally:
+            pool.terminate()
+
+    if state:
+        save_state(args.state_file, state)
 
     if fix_them and args.fix_values:
         logger.info(u"Fixing those events and resetting _Order Forward...")
-        for i, e in enumerate(fix_them, 1):
-            fixed = fix_event(e, root_compscores)
-            logger.info(u"[{}/{}] Pushing event {}...".format(i, len(fix_them), e['event']))
-            api.put('events/{}'.format(e['event']), data=fixed)
+        journal = Journal(journal_filename(args.state_file) if args.state_file else JOURNAL, resume=args.resume)
+        with journal, phase('fix'):
+            fix_events(api, fix_them, root_compscores, args.batch_size, journal)
     else:
         logger.warn(u"Not fixing events")
 
@@ -2,17 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
 import sys
-import time
 
-from dhis2 import Api, setup_logger, logger, load_csv
-from .attribute_setter import create_or_update_attributevalues
+from .attribute_setter import attributevalues_patch, create_or_update_attributevalues
+from .journal import Journal, journal_filename
+from .lazy import load_csv, logger, setup_logger
+from .metrics import add_metrics_arguments, phase
+from .planner import Plan
+from .utils import chunk, positive_int, run_concurrently
+from .validation import check, report_filename, validate_rows
 
 USER_MESSAGE_UID = 'ct3X8eB5gRj'
+USERNAME_CHUNK_SIZE = 50
+USER_FIELDS = ':owner,userGroups'
+# enough to build a JSON Patch of the attribute values
+USER_PATCH_FIELDS = 'id,username,userCredentials[username],attributeValues'
 
 
 def parse_args():
-    usage = "hnqis-user-message [-s] [-u] [-p] -c -t -a" \
+    usage = "hnqis-user-message [-s] [-u] [-p] -c [-w] [--plan] [--resume] [--metrics] [--trace]" \
             "\n\n\033[1mExample:\033[0m " \
             "\nhnqis-user-message -s=data.psi-mis.org -u=admin -p=district -c=/path/to/file.csv" \
             "\n\n\033[1mCSV file structure:\033[0m         " \
@@ -26,75 +35,150 @@ def parse_args():
                         help="DHIS2 server URL without /api/ e.g. -s=play.dhis2.org/demo")
     parser.add_argument('-c', dest='source_csv', action='store', help="CSV file with Messages",
                         required=True)
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=positive_int, default=1,
+                        required=False, help="Number of users to update concurrently, e.g. -w=8")
+    parser.add_argument('--plan', dest='plan', action='store_true', default=False, required=False,
+                        help="Only estimate requests, transferred bytes and runtime of this run (read-only)")
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False, required=False,
+                        help="Skip rows already applied by a previous run (recorded in <CSV>_journal.jsonl)")
     parser.add_argument('-u', dest='username', action='store', help="DHIS2 username")
     parser.add_argument('-p', dest='password', action='store', help="DHIS2 password")
     parser.add_argument('-d', dest='debug', action='store_true', default=False, required=False,
                         help="Writes more info in log file")
 
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
-def validate_csv(data):
-    if not data[0].get('username', None) or not data[0].get('message', None):
-        raise ValueError("CSV not valid: CSV must have 'username' and 'message' as headers")
+def validate_csv(data, report=None):
+    """Validate rows (any iterable, e.g. load_csv) in one pass, optionally writing all errors to a CSV report"""
+    return check(validate_rows(data, required=['username', 'message'], key='username', key_is_uid=False), report)
 
-    object_uids = [obj['username'] for obj in data]
 
-    duplicates = set([x for x in object_uids if object_uids.count(x) > 1])
-    if duplicates:
-        raise ValueError("Duplicate users found in the CSV: {}".format(', '.join(duplicates)))
-    return True
+def get_username(user):
+    """Username of a user - part of userCredentials before DHIS2 2.36"""
+    return user.get('userCredentials', {}).get('username') or user.get('username')
+
+
+def index_users(api, usernames, chunk_size=USERNAME_CHUNK_SIZE, fields=USER_FIELDS):
+    """Fetch users in chunks with a `username:in` filter and return a username -> user dict"""
+    users = {}
+    for chunk_usernames in chunk(usernames, chunk_size):
+        params = {
+            'fields': fields,
+            'filter': 'userCredentials.userInfo.userCredentials.username:in:[{}]'.format(','.join(chunk_usernames)),
+            'paging': False
+        }
+        for user in api.get('users', params=params).json()['users']:
+            users[get_username(user)] = user
+    return users
+
+
+def add_message(api, user, message, patch=False):
+    """Set the message attribute value of a user - with a JSON Patch if `patch` is set
+    (the user only needs to be fetched with USER_PATCH_FIELDS then). If the server rejects the PATCH,
+    the user is fetched with USER_FIELDS and updated with a PUT."""
+    if patch and api.supports_json_patch:
+        from dhis2 import RequestException
+        user_updated = create_or_update_attributevalues(obj=user, attribute_uid=USER_MESSAGE_UID,
+                                                        attribute_value=message)
+        try:
+            api.json_patch('users/{}'.format(user['id']), attributevalues_patch(user_updated))
+            return
+        except RequestException:
+            if api.supports_json_patch:
+                raise
+    if patch:
+        user = api.get('users/{}'.format(user['id']), params={'fields': USER_FIELDS}).json()
+    user_updated = create_or_update_attributevalues(obj=user, attribute_uid=USER_MESSAGE_UID,
+                                                    attribute_value=message)
+    api.put('users/{}'.format(user['id']), params=None, data=user_updated)
+
+
+def plan_run(api, args, data):
+    """Estimate the run from the size of the first user"""
+    plan = Plan(api, workers=args.workers)
+    patch = api.supports_json_patch
+    sample = index_users(api, [data[0]['username']], fields=USER_PATCH_FIELDS if patch else USER_FIELDS)
+    size = len(json.dumps(list(sample.values())))
+    total = size * len(data)
+    plan.add(u"fetch users in chunks", 'GET', 'users', -(-len(data) // USERNAME_CHUNK_SIZE), download=total)
+    plan.add(u"update users", 'PATCH' if patch else 'PUT', 'users/<uid>', len(data), upload=total, concurrent=True)
+    return plan
 
 
 def main():
     args = parse_args()
     setup_logger()
-    api = Api(server=args.server, username=args.username, password=args.password)
+    from .client import create_api
+    api = create_api(args, pool_size=args.workers)
 
-    if '.psi-mis.org' not in args.server and '.hnqis.org' not in args.server:
+    if '.psi-mis.org' not in api.base_url and '.hnqis.org' not in api.base_url:
         logger.warn("This script is intended only for *.psi-mis.org or *.hnqis.org")
         sys.exit()
 
-    data = list(load_csv(args.source_csv))
-    validate_csv(data)
+    with phase('validate'):
+        validate_csv(load_csv(args.source_csv), report=report_filename(args.source_csv))
+    with phase('load_csv'):
+        data = list(load_csv(args.source_csv))
 
     attr = api.get('attributes/{}'.format(USER_MESSAGE_UID), params={'fields': 'id,name,userAttribute'}).json()
     if attr['userAttribute'] is False:
         logger.error("Attribute {} is not assigned to Users".format(USER_MESSAGE_UID))
 
+    journal = Journal(journal_filename(args.source_csv), resume=args.resume)
+
+    def entry(obj):
+        return obj.get('username'), obj.get('message')
+
+    pending = journal.pending(data, entry)
+    if len(pending) < len(data):
+        logger.info(u"Resuming - skipping {} rows already applied".format(len(data) - len(pending)))
+        data = pending
+    if not data:
+        logger.info(u"All rows already applied")
+        return
+
+    if args.plan:
+        plan_run(api, args, data).report()
+        return
+
     logger.info("[{}] - Adding messages for {} users...".format(args.server, len(data)))
-    try:
-        time.sleep(3)
-    except KeyboardInterrupt:
-        logger.error("Aborted!")
-        pass
-
-    for i, obj in enumerate(data, 1):
-        # Look up user UID
-        username = obj.get('username')
-        params_user = {
-            'fields': 'id,name',
-            'filter': 'userCredentials.userInfo.userCredentials.username:eq:{}'.format(username)
-        }
-        lookup = api.get('users', params=params_user).json()
-        try:
-            user_uid = lookup['users'][0]['id']
-        except IndexError:
-            print(u"User with username {} could not be found. Skipping...".format(username))
-            pass
-        else:
-            attribute_value = obj.get('message')
-            params_get = {'fields': ':owner,userGroups'}
-            user = api.get('users/{}'.format(user_uid), params=params_get).json()
-            user_updated = create_or_update_attributevalues(obj=user, attribute_uid=USER_MESSAGE_UID,
-                                                            attribute_value=attribute_value)
+    patch = api.supports_json_patch
+    if patch:
+        logger.info(u"Server supports JSON Patch - updating only Attribute Values")
+    with phase('fetch'):
+        users = index_users(api, [obj.get('username') for obj in data],
+                            fields=USER_PATCH_FIELDS if patch else USER_FIELDS)
+
+    def update_row(obj):
+        user = users.get(obj.get('username'))
+        if not user:
+            return False
+        add_message(api, user, obj.get('message'), patch)
+        journal.record(entry(obj))
+        return True
+
+    with phase('update'):
+        failed = []
+        for i, (obj, found, error) in enumerate(run_concurrently(update_row, data, args.workers), 1):
+            username = obj.get('username')
+            if error:
+                logger.warn(u"{}/{} - Failed {}: {} - retrying later".format(i, len(data), username, error))
+                failed.append(obj)
+            elif not found:
+                print(u"User with username {} could not be found. Skipping...".format(username))
+            else:
+                logger.info(u"{}/{} - Added message for username {}".format(i, len(data), username))
+
+        for obj in failed:
             try:
-                api.put('users/{}'.format(user_uid), params=None, data=user_updated)
+                update_row(obj)
             except Exception as e:
-                logger.error("failed: {} {}".format(user_uid, e))
-                pass
+                logger.error(u"failed: {} {}".format(obj.get('username'), e))
             else:
-                logger.info("{}/{} - Added message for username {}".format(i, len(data), username))
+                logger.info(u"Retried - Added message for username {}".format(obj.get('username')))
+    journal.close()
 
 
 if __name__ == "__main__":
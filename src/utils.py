@@ -1,5 +1,14 @@
+import argparse
 import csv
+import json
+import os
 import sys
+import tempfile
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+# Python 2 has no os.replace - os.rename replaces an existing file atomically on POSIX too
+replace = getattr(os, 'replace', os.rename)
 
 
 def write_csv(data, filename, header_row):
@@ -14,3 +23,95 @@ def write_csv(data, filename, header_row):
         writer = csv.writer(fp, delimiter=str(','))
         writer.writerow(header_row)
         writer.writerows(data)
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    """Write to a temporary file next to `path` that replaces `path` when the block completes,
+    so no reader (or a crash while writing) ever leaves a half-written file behind"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def positive_int(value):
+    """argparse type for sizes and counts that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(u"must be at least 1, got {}".format(value))
+    return number
+
+
+def chunk(items, size):
+    """Yield successive lists of `size` items"""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def post_metadata(api, data, params=None):
+    """POST to /api/metadata and return the import report - also if DHIS2 rejected objects (409)"""
+    from dhis2 import RequestException
+    try:
+        return api.post('metadata', params=params, data=data).json()
+    except RequestException as e:
+        try:
+            return json.loads(e.description)
+        except ValueError:
+            raise e
+
+
+def import_report_errors(report, objects=None):
+    """Map UIDs of objects rejected in a /api/metadata import report to their error messages.
+    Newer DHIS2 versions wrap the report in a `response` key. If an object report has no UID,
+    its `index` is resolved against `objects` (the list that was posted)."""
+    report = report.get('response', report)
+    errors = {}
+    for type_report in report.get('typeReports', []):
+        for object_report in type_report.get('objectReports', []):
+            messages = [e.get('message', '') for e in object_report.get('errorReports', [])]
+            if not messages:
+                continue
+            uid = object_report.get('uid')
+            if not uid and objects is not None and object_report.get('index') is not None:
+                uid = objects[object_report['index']].get('id')
+            errors.setdefault(uid, []).extend(messages)
+    return errors
+
+
+def failed_import_references(summaries, objects=None):
+    """Return UIDs of objects with status ERROR in an ImportSummaries response (e.g. from /api/events).
+    If a summary has no reference, its position is resolved against `objects` (the list that was posted)."""
+    summaries = summaries.get('response', summaries)
+    failed = []
+    for i, summary in enumerate(summaries.get('importSummaries', [])):
+        if summary.get('status') != 'ERROR':
+            continue
+        reference = summary.get('reference')
+        if not reference and objects is not None and i < len(objects):
+            reference = objects[i].get('event', objects[i].get('id'))
+        failed.append(reference)
+    return failed
+
+
+def run_concurrently(func, items, workers):
+    """Call func(item) for every item on a pool of `workers` threads.
+    Yields (item, result, exception) tuples in completion order - exception is None on success."""
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        for outcome in pool.imap_unordered(call, items):
+            yield outcome
+    finally:
+        pool.terminate()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+
+from .utils import write_csv
+
+UID_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9]{10}$')
+REPORT_HEADER = ['line', 'column', 'value', 'error']
+
+
+def is_uid(value):
+    return bool(value) and UID_PATTERN.match(value) is not None
+
+
+def validate_rows(rows, required, key, key_is_uid=True, uid_headers=False):
+    """Validate CSV rows (dicts, e.g. from load_csv) in a single pass.
+    Only the values of the `key` column are kept in memory to detect duplicates.
+    :param required: headers that must exist and must not have empty values
+    :param key: column with the identifier of a row - must be unique
+    :param key_is_uid: `key` values must be valid UIDs
+    :param uid_headers: all headers except `key` must be valid UIDs (and there must be at least one)
+    :return: list of (line, column, value, error) tuples, line 1 being the header row
+    """
+    errors = []
+    seen = set()
+    line = 1
+    for line, row in enumerate(rows, 2):
+        if line == 2:
+            headers = [h for h in row if h is not None]
+            errors.extend(validate_headers(headers, required, key, uid_headers))
+            if errors:
+                return errors
+        for column in required:
+            if column != key and not row[column]:
+                errors.append((line, column, '', u"Empty value"))
+        value = row[key]
+        if key_is_uid and not is_uid(value):
+            errors.append((line, key, value, u"{} is not a valid UID".format(value)))
+        elif not key_is_uid and not value:
+            errors.append((line, key, '', u"Empty value"))
+        if value in seen:
+            errors.append((line, key, value, u"Duplicate {}".format(value)))
+        else:
+            seen.add(value)
+    if line == 1:
+        errors.append((1, '', '', u"CSV not valid (empty?)"))
+    return errors
+
+
+def validate_headers(headers, required, key, uid_headers):
+    errors = []
+    for column in required:
+        if column not in headers:
+            errors.append((1, column, '', u"CSV must have '{}' header".format(column)))
+    if uid_headers:
+        others = [h for h in headers if h != key]
+        if not others:
+            errors.append((1, '', '', u"No UID columns found in CSV"))
+        for h in others:
+            if not is_uid(h):
+                errors.append((1, h, h, u"{} is not a valid UID".format(h)))
+    return errors
+
+
+def report_filename(source_csv):
+    """e.g. /path/to/file.csv -> /path/to/file_errors.csv"""
+    return u"{}_errors.csv".format(os.path.splitext(source_csv)[0])
+
+
+def check(errors, report=None):
+    """Write errors to a CSV report (if given) and raise a ValueError summarizing them"""
+    if not errors:
+        return True
+    if report:
+        write_csv(errors, report, REPORT_HEADER)
+    line, column, value, error = errors[0]
+    message = u"CSV not valid: {} error(s), first on line {}: {}".format(len(errors), line, error)
+    if report:
+        message += u" - see {}".format(report)
+    raise ValueError(message)
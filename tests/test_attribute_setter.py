@@ -318,3 +318,134 @@ def test_attribute_added_value(user_added_attributevalues):
     user_added_attributevalues.pop('attributeValues')
     pairs = zip(updated, user_added_attributevalues)
     assert any(x != y for x, y in pairs)
+
+
+def test_chunk():
+    chunks = list(chunk(['a', 'b', 'c', 'd', 'e'], 2))
+    assert chunks == [['a', 'b'], ['c', 'd'], ['e']]
+
+
+def test_import_report_errors():
+    report = {
+        "httpStatus": "Conflict",
+        "response": {
+            "status": "WARNING",
+            "typeReports": [
+                {
+                    "klass": "org.hisp.dhis.organisationunit.OrganisationUnit",
+                    "objectReports": [
+                        {"index": 0, "uid": "hvitKDL9qRH", "errorReports": [{"message": "Invalid value"}]},
+                        {"index": 1, "errorReports": [{"message": "Missing name"}]},
+                        {"index": 2, "uid": "DiszpKrYNg8", "errorReports": []}
+                    ]
+                }
+            ]
+        }
+    }
+    objects = [{"id": "hvitKDL9qRH"}, {"id": "rxFEOPYJVxL"}, {"id": "DiszpKrYNg8"}]
+    errors = import_report_errors(report, objects)
+    assert errors == {"hvitKDL9qRH": ["Invalid value"], "rxFEOPYJVxL": ["Missing name"]}
+
+
+def test_run_concurrently():
+    def func(x):
+        if x == 3:
+            raise ValueError("failed")
+        return x * 2
+
+    outcomes = {item: (result, error) for item, result, error in run_concurrently(func, range(6), 4)}
+    assert set(outcomes) == set(range(6))
+    assert outcomes[2] == (4, None)
+    assert isinstance(outcomes[3][1], ValueError)
+
+
+def test_csv_wide():
+    f = list(load_csv(path=os.path.join(PATH, 'wide.csv')))
+    assert validate_csv(f, wide=True)
+    # a key,value CSV has no Attribute UID headers
+    with pytest.raises(ValueError):
+        validate_csv(list(load_csv(path=os.path.join(PATH, 'valid.csv'))), wide=True)
+
+    assert [row_values(row) for row in f] == [
+        {TEST_ATTRIBUTE_UID: '333', 'pt5Ll9bb2oP': 'blue'},
+        {'pt5Ll9bb2oP': 'green'}
+    ]
+    assert row_values({'key': 'hvitKDL9qRH', 'value': '333'}, TEST_ATTRIBUTE_UID) == {TEST_ATTRIBUTE_UID: '333'}
+
+
+def test_attribute_values_updated(user_with_attributevalue):
+    values = {TEST_ATTRIBUTE_UID: 'new', 'pt5Ll9bb2oP': 'blue'}
+    updated = create_or_update_attributevalues(obj=user_with_attributevalue, values=values)
+    assert sorted((x['attribute']['id'], x['value']) for x in updated['attributeValues']) == sorted(values.items())
+    assert journal_entries('users', 'DXyJmlo9rge', values) == [
+        ('users', TEST_ATTRIBUTE_UID, 'DXyJmlo9rge', 'new'),
+        ('users', 'pt5Ll9bb2oP', 'DXyJmlo9rge', 'blue')
+    ]
+
+
+def test_update_objects_bulk_failed_put(monkeypatch, tmpdir):
+    import src.attribute_setter as attribute_setter
+    from src.journal import Journal
+
+    class FakeApi(object):
+        def get(self, endpoint, params=None):
+            ids = params['filter'][len('id:in:['):-1].split(',')
+
+            class Response(object):
+                def json(self):
+                    return {endpoint: [{'id': uid, 'attributeValues': []} for uid in ids]}
+
+            return Response()
+
+    def update_object(api, object_type, obj_uid, values, patch=False):
+        if obj_uid == 'rxFEOPYJVxL':
+            raise ValueError("Server error")
+
+    # None: an object report without uid or index
+    monkeypatch.setattr(attribute_setter, 'import_metadata',
+                        lambda api, object_type, objects: {'hvitKDL9qRH', 'rxFEOPYJVxL', None})
+    monkeypatch.setattr(attribute_setter, 'update_object', update_object)
+    rows = [(uid, {TEST_ATTRIBUTE_UID: 'x'}) for uid in ('hvitKDL9qRH', 'rxFEOPYJVxL', 'DiszpKrYNg8')]
+    with Journal(str(tmpdir.join('journal.jsonl'))) as journal:
+        update_objects_bulk(FakeApi(), 'organisationUnits', rows, 2, journal)
+        assert sorted(e[2] for e in journal.applied) == ['DiszpKrYNg8', 'hvitKDL9qRH']
+
+
+class AttributesApi(object):
+    """Answers the id:in request of check_attributes"""
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.params = None
+
+    def get(self, endpoint, params=None):
+        self.params = params
+        attributes = self.attributes
+
+        class Response(object):
+            def json(self):
+                return {'attributes': attributes}
+
+        return Response()
+
+
+def test_check_attributes():
+    api = AttributesApi([{'id': TEST_ATTRIBUTE_UID, 'name': 'Message', 'userAttribute': True},
+                         {'id': 'pt5Ll9bb2oP', 'name': 'Colour', 'userAttribute': False}])
+    check_attributes(api, 'users', [TEST_ATTRIBUTE_UID])
+    assert api.params['filter'] == 'id:in:[{}]'.format(TEST_ATTRIBUTE_UID)
+    assert api.params['fields'] == 'id,name,userAttribute'
+
+    # not assigned to users
+    with pytest.raises(ValueError):
+        check_attributes(api, 'users', [TEST_ATTRIBUTE_UID, 'pt5Ll9bb2oP'])
+    # mistyped header
+    with pytest.raises(ValueError):
+        check_attributes(api, 'users', [TEST_ATTRIBUTE_UID, 'pt5Ll9bb2oX'])
+
+
+@pytest.mark.parametrize('argument', ['-b=0', '-b=-5', '-w=0'])
+def test_sizes_below_one_rejected(argument, monkeypatch):
+    monkeypatch.setattr('sys.argv', ['hnqis-attribute-setting', '-c=file.csv', '-t=users', argument])
+    with pytest.raises(SystemExit):
+        parse_args()
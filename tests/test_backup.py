@@ -0,0 +1,43 @@
+import gzip
+import os
+
+import pytest
+
+from src.backup import *
+
+
+@pytest.fixture
+def programs():
+    return {'programs': [{'id': 'VBqh0ynB2wv', 'name': u'Malaria case registration é',
+                          'organisationUnits': [{'id': 'bVZTNrnfn9G'}, {'id': 'Nxw94OjsCjS'}]}]}
+
+
+def test_write_and_read_backup(tmpdir, programs):
+    directory = str(tmpdir)
+    path = write_backup(programs, 'programs', directory)
+    assert path.endswith('.json.gz')
+    assert read_backup(path) == programs
+
+    with gzip.open(path, 'rb') as gz:
+        assert b'\n' not in gz.read()
+
+    manifest = load_manifest(directory)
+    assert len(manifest) == 1
+    assert manifest[0]['objects'] == {'programs': 1}
+
+
+def test_backup_same_content_reuses_file(tmpdir, programs):
+    directory = str(tmpdir)
+    path1 = write_backup(programs, 'programs', directory)
+    path2 = write_backup(programs, 'programs', directory)
+    assert path1 == path2
+    assert len(load_manifest(directory)) == 2
+    assert len([f for f in os.listdir(directory) if f.endswith('.json.gz')]) == 1
+
+
+def test_read_backup_checksum_mismatch(tmpdir, programs):
+    path = write_backup(programs, 'programs', str(tmpdir))
+    with gzip.open(path, 'wb') as gz:
+        gz.write(b'{"programs":[]}')
+    with pytest.raises(ValueError):
+        read_backup(path)
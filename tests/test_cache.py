@@ -0,0 +1,110 @@
+import json
+import os
+
+import pytest
+import requests
+
+from src.cache import *
+
+
+class EtagApi(object):
+    """Serves a fixed payload with an ETag and answers 304 to a matching If-None-Match"""
+    base_url = 'https://data.psi-mis.org'
+    username = 'admin'
+
+    def __init__(self, data, etag='"abc"'):
+        self.data = data
+        self.etag = etag
+        self.requests = []
+
+    def get(self, endpoint, params=None, headers=None):
+        self.requests.append(headers)
+        r = requests.Response()
+        r.headers['ETag'] = self.etag
+        if headers and headers.get('If-None-Match') == self.etag:
+            r.status_code = 304
+        else:
+            r.status_code = 200
+            r._content = json.dumps(self.data).encode('utf-8')
+        return r
+
+
+@pytest.fixture
+def programs():
+    return {'programs': [{'id': 'VBqh0ynB2wv'}, {'id': 'lxAQ7Zs9VYR'}]}
+
+
+def test_cache_hit_within_ttl(tmpdir, programs):
+    api = EtagApi(programs)
+    cache = Cache(directory=str(tmpdir))
+    assert cache.get(api, 'programs', {'fields': 'id'}) == programs
+    assert cache.get(api, 'programs', {'fields': 'id'}) == programs
+    assert len(api.requests) == 1
+
+
+def test_cache_revalidates_after_ttl(tmpdir, programs):
+    api = EtagApi(programs)
+    cache = Cache(directory=str(tmpdir), ttl=0)
+    cache.get(api, 'programs', {'fields': 'id'})
+    assert cache.get(api, 'programs', {'fields': 'id'}) == programs
+    assert api.requests == [None, {'If-None-Match': '"abc"'}]
+
+    api.data, api.etag = {'programs': []}, '"def"'
+    assert cache.get(api, 'programs', {'fields': 'id'}) == {'programs': []}
+
+
+def test_cache_disabled(tmpdir, programs):
+    api = EtagApi(programs)
+    cache = Cache(directory=str(tmpdir), enabled=False)
+    cache.get(api, 'programs')
+    cache.get(api, 'programs')
+    assert len(api.requests) == 2
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_cache_eviction(tmpdir, programs):
+    api = EtagApi(programs)
+    cache = Cache(directory=str(tmpdir), max_bytes=150)
+    cache.get(api, 'programs', {'page': 1})
+    cache.get(api, 'programs', {'page': 2})
+    assert len(os.listdir(str(tmpdir))) == 1
+
+
+def test_cache_write_failure_returns_data(tmpdir, programs):
+    # a file where the cache directory should be, like a read-only or full ~/.cache
+    blocker = tmpdir.join('blocker')
+    blocker.write('')
+    cache = Cache(directory=str(blocker.join('hnqis-cli')))
+    assert cache.get(EtagApi(programs), 'programs') == programs
+
+
+def test_cache_touch_failure_returns_entry(tmpdir, programs, monkeypatch):
+    api = EtagApi(programs)
+    cache = Cache(directory=str(tmpdir))
+    cache.get(api, 'programs')
+
+    def utime(path, times):
+        raise OSError(30, 'Read-only file system')
+
+    monkeypatch.setattr('src.cache.os.utime', utime)
+    assert cache.get(api, 'programs') == programs
+    assert len(api.requests) == 1
+
+
+def test_cache_entry_replaced_whole(tmpdir, programs, monkeypatch):
+    cache = Cache(directory=str(tmpdir))
+    cache.get(EtagApi(programs), 'programs')
+
+    def dump(obj, f):
+        f.write('{"etag": ')
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr('src.cache.json.dump', dump)
+    with pytest.raises(KeyboardInterrupt):
+        cache._store(cache._path(EtagApi(programs), 'programs', None), None, {})
+    monkeypatch.undo()
+    # the interrupted write left neither a temporary file nor a broken entry
+    names = os.listdir(str(tmpdir))
+    assert len(names) == 1
+    with open(os.path.join(str(tmpdir), names[0])) as f:
+        assert json.load(f)['data'] == programs
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from src.cli import *
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# seconds `hnqis <command> --help` may take on top of starting Python
+STARTUP_BUDGET = 0.3
+
+LOADED_MODULES = """
+import sys
+from src.cli import main
+try:
+    main([sys.argv[1], '--help'])
+except SystemExit:
+    pass
+print('loaded:' + ','.join(m for m in ('dhis2', 'requests', 'six', 'src.client') if m in sys.modules))
+"""
+
+
+def python(*args):
+    start = time.time()
+    output = subprocess.check_output((sys.executable,) + args, cwd=ROOT)
+    return time.time() - start, output.decode('utf-8')
+
+
+@pytest.mark.parametrize('command', [name for name, _, _ in COMMANDS])
+def test_help_does_not_import_dhis2(command):
+    _, output = python('-c', LOADED_MODULES, command)
+    assert output.splitlines()[-1] == 'loaded:'
+
+
+def test_startup_time():
+    python_startup = min(python('-c', 'pass')[0] for _ in range(3))
+    startup = min(python('-m', 'src.cli', 'scan-mismatches', '--help')[0] for _ in range(3))
+    assert startup - python_startup < STARTUP_BUDGET
+
+
+def test_unknown_command(capsys):
+    with pytest.raises(SystemExit):
+        main(['attribute-settings'])
+    assert 'attribute-setting' in capsys.readouterr().out
@@ -0,0 +1,123 @@
+import pytest
+import requests
+import urllib3
+
+from src.client import *
+
+
+def make_response(status_code):
+    r = requests.Response()
+    r.status_code = status_code
+    r.url = 'http://localhost:8080/api/programs.json'
+    r._content = b'{"programs": []}'
+    return r
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr('src.client.time.sleep', lambda seconds: None)
+    return Client('localhost:8080', 'admin', 'district', retries=2)
+
+
+def test_backoff():
+    assert [backoff(i) for i in range(4)] == [1, 2, 4, 8]
+    assert backoff(20) == BACKOFF_MAX_SECONDS
+
+
+def test_retry_on_server_error(client):
+    responses = [make_response(502), make_response(429), make_response(200)]
+    client.session.get = lambda *args, **kwargs: responses.pop(0)
+    assert client.get('programs').json() == {'programs': []}
+    assert len(client.timings['GET programs']) == 3
+
+
+def test_no_retry_on_client_error(client):
+    responses = [make_response(404), make_response(200)]
+    client.session.get = lambda *args, **kwargs: responses.pop(0)
+    with pytest.raises(RequestException):
+        client.get('programs/VBqh0ynB2wv')
+    assert len(client.timings['GET programs']) == 1
+
+
+def test_retries_exhausted(client):
+    client.session.get = lambda *args, **kwargs: make_response(503)
+    with pytest.raises(RequestException):
+        client.get('programs')
+    assert len(client.timings['GET programs']) == 3
+
+
+def test_delete_with_payload(client):
+    sent = {}
+
+    def delete(url, json=None, params=None):
+        sent['url'], sent['json'] = url, json
+        return make_response(200)
+
+    client.session.delete = delete
+    payload = {'identifiableObjects': [{'id': 'Nxw94OjsCjS'}]}
+    client.delete('programs/VBqh0ynB2wv/organisationUnits', data=payload)
+    assert sent['url'].endswith('/api/programs/VBqh0ynB2wv/organisationUnits')
+    assert sent['json'] == payload
+
+
+def test_post_not_retried_on_server_error(client):
+    responses = [make_response(502), make_response(200)]
+    client.session.post = lambda *args, **kwargs: responses.pop(0)
+    with pytest.raises(RequestException):
+        client.post('metadata', data={'programs': []})
+    assert len(client.timings['POST metadata']) == 1
+
+
+def test_post_retried_on_too_many_requests(client):
+    responses = [make_response(429), make_response(200)]
+    client.session.post = lambda *args, **kwargs: responses.pop(0)
+    client.post('metadata', data={'programs': []})
+    assert len(client.timings['POST metadata']) == 2
+
+
+@pytest.mark.parametrize('error,retried', [
+    (requests.ConnectTimeout(), True),
+    (requests.ConnectionError(urllib3.exceptions.MaxRetryError(
+        None, '/api/metadata', urllib3.exceptions.NewConnectionError(None, 'refused'))), True),
+    (requests.ConnectionError(urllib3.exceptions.ProtocolError('Connection aborted.')), False),
+    (requests.ReadTimeout(), False)
+])
+def test_post_retried_only_before_sent(client, error, retried):
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise error
+        return make_response(200)
+
+    client.session.post = post
+    if retried:
+        client.post('events', data={'events': []})
+    else:
+        with pytest.raises(requests.RequestException):
+            client.post('events', data={'events': []})
+    assert len(calls) == (2 if retried else 1)
+
+
+def test_get_retried_on_read_timeout(client):
+    calls = []
+
+    def get(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise requests.ReadTimeout()
+        return make_response(200)
+
+    client.session.get = get
+    assert client.get('programs').json() == {'programs': []}
+
+
+def test_default_timeout(monkeypatch):
+    client = Client('localhost:8080', 'admin', 'district', timeout=(1, 2))
+    sent_kwargs = {}
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send',
+                        lambda self, request, **kwargs: sent_kwargs.update(kwargs))
+    adapter = client.session.get_adapter('http://localhost:8080/api/programs.json')
+    adapter.send(requests.Request('GET', 'http://localhost:8080/api/programs.json').prepare())
+    assert sent_kwargs['timeout'] == (1, 2)
@@ -0,0 +1,124 @@
+import pytest
+
+from benchmarks.fake_dhis2 import ATTRIBUTE_UID, FakeDhis2, ROOT_COMPSCORE, select
+from src.attribute_setter import update_object
+from src.client import Client
+from src.scan_event_mismatches import OVERALL_SCORE, ORDER_FORWARD, fix_events, scan_program
+from src.user_message import USER_FIELDS, USER_MESSAGE_UID, USER_PATCH_FIELDS, add_message, index_users
+
+
+@pytest.fixture
+def server():
+    with FakeDhis2(programs=2, orgunits=10, users=120, events=25, mismatch_every=5) as fake:
+        yield fake
+
+
+@pytest.mark.parametrize('fields', ['id,name', '[id,name]', 'id,name,organisationUnits[id]'])
+def test_select(fields):
+    program = {'id': 'P0000000001', 'name': 'HNQIS - CBRM 1', 'organisationUnits': [{'id': 'O0000000001'}]}
+    expected = {'id', 'name', 'organisationUnits'} if 'organisationUnits' in fields else {'id', 'name'}
+    assert set(select(program, fields)) == expected
+
+
+def test_query_bracketed_fields(server):
+    api = Client(server.url, 'admin', 'district')
+    r = api.get('programIndicators', params={'paging': False, 'fields': '[id,name]'})
+    assert all(set(pi) == {'id', 'name'} for pi in r.json()['programIndicators'])
+
+
+def test_index_users(server):
+    api = Client(server.url, 'admin', 'district')
+    users = index_users(api, [u"user{}".format(i) for i in range(0, 120, 2)], chunk_size=50)
+    assert len(users) == 60
+    assert server.requests == 2
+
+
+def test_scan_and_fix(server):
+    api = Client(server.url, 'admin', 'district')
+    program = {'id': 'P0000000001', 'name': 'HNQIS - CBRM 1'}
+    data_elements = {ROOT_COMPSCORE, OVERALL_SCORE, ORDER_FORWARD}
+    rows, _, _ = scan_program(api, program, [ROOT_COMPSCORE], data_elements, page_size=10)
+    assert len(rows) == 5
+
+    fix_events(api, [row[3] for row in rows], [ROOT_COMPSCORE], batch_size=2)
+    rows, _, _ = scan_program(api, program, [ROOT_COMPSCORE], data_elements, page_size=10)
+    assert rows == []
+
+
+@pytest.mark.parametrize('version,method', [('2.36.0', 'PUT'), ('2.37.1', 'PATCH')])
+def test_update_object_patch_or_put(version, method):
+    with FakeDhis2(version=version, orgunits=2, users=0, programs=0, events=0) as server:
+        api = Client(server.url, 'admin', 'district')
+        orgunit = server.data['organisationUnits'][0]
+        orgunit['attributeValues'] = [{'attribute': {'id': 'M8fCOxtkURr'}, 'value': 'kept'}]
+
+        update_object(api, 'organisationUnits', orgunit['id'], {ATTRIBUTE_UID: 'new'}, api.supports_json_patch)
+        assert list(api.timings) == ['GET system', 'GET organisationUnits', '{} organisationUnits'.format(method)]
+        assert sorted((a['attribute']['id'], a['value']) for a in orgunit['attributeValues']) == [
+            ('M8fCOxtkURr', 'kept'), (ATTRIBUTE_UID, 'new')]
+        assert orgunit['name'] == 'OrgUnit 0'
+
+
+def test_update_object_patch_rejected():
+    with FakeDhis2(version='2.36.0', orgunits=2, users=0, programs=0, events=0) as server:
+        api = Client(server.url, 'admin', 'district')
+        # 2.36 answers JSON Patch with 415 - the run switches to PUT
+        api._version_int = 37
+        for orgunit in server.data['organisationUnits']:
+            update_object(api, 'organisationUnits', orgunit['id'], {ATTRIBUTE_UID: 'new'}, patch=True)
+            assert orgunit['attributeValues'] == [{'attribute': {'id': ATTRIBUTE_UID}, 'value': 'new'}]
+        assert len(api.timings['PATCH organisationUnits']) == 1
+        assert len(api.timings['PUT organisationUnits']) == 2
+        assert not api.supports_json_patch
+
+
+@pytest.mark.parametrize('version,method', [('2.36.0', 'PUT'), ('2.37.1', 'PATCH')])
+def test_add_message_patch_or_put(version, method):
+    with FakeDhis2(version=version, orgunits=0, users=2, programs=0, events=0) as server:
+        api = Client(server.url, 'admin', 'district')
+        patch = api.supports_json_patch
+        users = index_users(api, ['user0'], fields=USER_PATCH_FIELDS if patch else USER_FIELDS)
+        add_message(api, users['user0'], u"Hi user0!", patch)
+        assert list(api.timings) == ['GET system', 'GET users', '{} users'.format(method)]
+        user = server.data['users'][0]
+        assert user['attributeValues'] == [{'attribute': {'id': USER_MESSAGE_UID}, 'value': u"Hi user0!"}]
+        assert user['userGroups'] == []
+
+
+def test_add_message_patch_rejected():
+    with FakeDhis2(version='2.36.0', orgunits=0, users=2, programs=0, events=0) as server:
+        api = Client(server.url, 'admin', 'district')
+        api._version_int = 37
+        users = index_users(api, ['user0', 'user1'], fields=USER_PATCH_FIELDS)
+        for username in ('user0', 'user1'):
+            add_message(api, users[username], u"Hi {}!".format(username), patch=True)
+        assert len(api.timings['PATCH users']) == 1
+        # the full user is fetched for the PUT
+        assert len(api.timings['GET users']) == 3
+        assert len(api.timings['PUT users']) == 2
+        assert [u['attributeValues'][0]['value'] for u in server.data['users']] == [u"Hi user0!", u"Hi user1!"]
+
+
+def test_unknown_version_no_json_patch():
+    with FakeDhis2(version='unknown', orgunits=0, users=0, programs=0, events=0) as server:
+        assert Client(server.url, 'admin', 'district').supports_json_patch is False
+
+
+class PlanArgs(object):
+    object_type = 'organisationUnits'
+    batch_size = None
+    workers = 4
+
+
+def test_attribute_plan_first_object_missing():
+    from src.attribute_setter import plan_run
+    with FakeDhis2(orgunits=2, users=0, programs=0, events=0) as server:
+        api = Client(server.url, 'admin', 'district')
+        rows = [('Omissing000', {ATTRIBUTE_UID: 'a'}), ('O0000000001', {ATTRIBUTE_UID: 'b'})]
+        plan = plan_run(api, PlanArgs(), rows)
+        assert plan.notes == []
+        assert plan.steps[0][5] > 0
+
+        plan = plan_run(api, PlanArgs(), [('Omissing000', {ATTRIBUTE_UID: 'a'})])
+        assert len(plan.notes) == 1
+        assert plan.steps[0][5] == 0
@@ -23,3 +23,69 @@ def test_create_numerators(program_indicators):
                "I{gWxh7DiRmG7} + I{ToQVD4irW3Q} + I{GxdhnY5wmHq} + I{ReQEl5V3z6p}"
     actual = create_numerator(program_indicators)
     assert expected == actual
+
+
+class FilterApi(object):
+    """Returns the filters of each query as the only object"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, endpoint, params=None):
+        self.calls += 1
+
+        class Response(object):
+            def json(self):
+                return {endpoint: [{'id': endpoint, 'filter': params['filter']}]}
+        return Response()
+
+
+def test_fetch_health_areas_in_order():
+    api = FilterApi()
+    results = fetch_health_areas(api, workers=8)
+    assert api.calls == 3 * len(HEALTH_AREAS)
+    assert [r[0] for r in results] == HEALTH_AREAS
+    for ha, programindicators, indicators, programs in results:
+        assert programindicators[0]['id'] == 'programIndicators'
+        assert indicators[0]['filter'] == ['name:eq:HNQIS - {} count'.format(ha)]
+        assert programs[0]['filter'][0] == 'shortName:like: HNQIS {}'.format(ha)
+
+
+def test_filter_predicate():
+    assert filter_predicate('name:eq:HNQIS - FP count')({'name': 'HNQIS - FP count'})
+    assert not filter_predicate('name:eq:HNQIS - FP count')({'name': 'HNQIS - FP CFC count'})
+    assert filter_predicate('name:like$:count')({'name': 'HNQIS - VMMC Follow-up count'})
+    assert filter_predicate('program.name:!like:v1')({'program': {'name': 'HNQIS FP v2'}})
+    assert not filter_predicate('program.name:!like:v1')({'program': {'name': 'HNQIS FP v1'}})
+    with pytest.raises(ValueError):
+        filter_predicate('name:in:[a,b]')
+
+
+def test_classify():
+    programindicators = [
+        {'id': 'GSae40Fyppf', 'name': 'HNQIS - FP count', 'program': {'name': 'HNQIS FP'}},
+        {'id': 'dSBYyCUjCXd', 'name': 'HNQIS - FP count', 'program': {'name': 'HNQIS FP v1'}},
+        {'id': 'tUdBD1JDxpn', 'name': 'HNQIS - FP CFC count', 'program': {'name': 'HNQIS FP CFC'}},
+        {'id': 'sGna2pquXOO', 'name': 'HNQIS - VMMC Surgery count', 'program': {'name': 'HNQIS VMMC Surgery'}},
+        {'id': 'Kswd1r4qWLh', 'name': 'HNQIS - VMMC Surgery average', 'program': {'name': 'HNQIS VMMC Surgery'}},
+    ]
+    indicators = [{'id': 'gWxh7DiRmG7', 'name': 'HNQIS - FP count'}, {'id': 'ToQVD4irW3Q', 'name': 'HNQIS - VMMC count'}]
+    programs = [
+        {'id': 'GxdhnY5wmHq', 'name': 'HNQIS FP', 'shortName': 'PSI HNQIS FP'},
+        {'id': 'ReQEl5V3z6p', 'name': 'HNQIS FP v1', 'shortName': 'PSI HNQIS FP old'},
+        {'id': 'VBqh0ynB2wv', 'name': 'HNQIS VMMC Surgery', 'shortName': 'PSI HNQIS VMMC Surgery'},
+    ]
+    results = {r[0]: r[1:] for r in classify(programindicators, indicators, programs)}
+    assert [r[0] for r in classify([], [], [])] == HEALTH_AREAS
+
+    fp_pis, fp_indicators, fp_programs = results['FP']
+    assert [p['id'] for p in fp_pis] == ['GSae40Fyppf']
+    assert [i['id'] for i in fp_indicators] == ['gWxh7DiRmG7']
+    assert [p['id'] for p in fp_programs] == ['GxdhnY5wmHq']
+
+    vmmc_pis, vmmc_indicators, vmmc_programs = results['VMMC']
+    assert [p['id'] for p in vmmc_pis] == ['sGna2pquXOO']
+    assert [i['id'] for i in vmmc_indicators] == ['ToQVD4irW3Q']
+    assert [p['id'] for p in vmmc_programs] == ['VBqh0ynB2wv']
+
+    assert [p['id'] for p in results['FP CFC'][0]] == ['tUdBD1JDxpn']
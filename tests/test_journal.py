@@ -0,0 +1,45 @@
+import os
+
+from src.journal import *
+
+
+def test_journal_filename():
+    assert journal_filename('/path/to/file.csv') == '/path/to/file_journal.jsonl'
+
+
+def test_journal_resume(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    with Journal(path) as journal:
+        journal.record(('users', 'pt5Ll9bb2oP', 'bVZTNrnfn9G', u'é'))
+        journal.record(('users', 'pt5Ll9bb2oP', 'Nxw94OjsCjS', '2'), ('users', 'pt5Ll9bb2oP', 'VBqh0ynB2wv', '3'))
+
+    resumed = Journal(path, resume=True)
+    assert len(resumed) == 3
+    assert ('users', 'pt5Ll9bb2oP', 'bVZTNrnfn9G', u'é') in resumed
+    # a changed value is not applied yet
+    assert ('users', 'pt5Ll9bb2oP', 'Nxw94OjsCjS', '5') not in resumed
+
+    rows = [{'key': 'Nxw94OjsCjS', 'value': '2'}, {'key': 'Nxw94OjsCjS', 'value': '5'}]
+    assert resumed.pending(rows, lambda r: ('users', 'pt5Ll9bb2oP', r['key'], r['value'])) == rows[1:]
+
+
+def test_journal_without_resume_starts_empty(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    with Journal(path) as journal:
+        journal.record(('bVZTNrnfn9G',))
+
+    journal = Journal(path)
+    assert len(journal) == 0
+    # not truncated before the first record, e.g. for --plan
+    assert load_journal(path) == {('bVZTNrnfn9G',)}
+    journal.record(('Nxw94OjsCjS',))
+    journal.close()
+    assert load_journal(path) == {('Nxw94OjsCjS',)}
+
+
+def test_journal_ignores_cut_off_line(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    with open(path, 'w') as f:
+        f.write('["bVZTNrnfn9G"]\n["Nxw9')
+    assert load_journal(path) == {('bVZTNrnfn9G',)}
+    assert load_journal(str(tmpdir.join('missing.jsonl'))) == set()
@@ -0,0 +1,54 @@
+import json
+from collections import defaultdict
+
+from src.metrics import *
+
+
+class RecordedApi(object):
+
+    def __init__(self, timings, transferred):
+        self.timings = defaultdict(list, timings)
+        self.transferred = defaultdict(lambda: [0, 0], transferred)
+
+
+def test_percentile():
+    values = [0.5, 0.1, 0.3, 0.2, 0.4]
+    assert percentile(values, 50) == 0.3
+    assert percentile(values, 99) == 0.5
+    assert percentile([0.7], 90) == 0.7
+
+
+def test_union_seconds():
+    assert union_seconds([]) == 0
+    assert union_seconds([(0, 2), (1, 3), (5, 6), (5.5, 5.7)]) == 4
+
+
+def test_summary_phases_and_requests():
+    metrics = Metrics()
+    start = metrics.started
+    metrics.add_span('network', 'GET programs', start + 1, 2)
+    metrics.add_span('network', 'GET programs', start + 2, 2)
+    metrics.add_span('phase', 'fetch', start, 5)
+    metrics.add_span('phase', 'validate', start + 5, 1)
+    api = RecordedApi({'GET programs': [2, 2]}, {'GET programs': [0, 1000]})
+
+    summary = metrics.summary(api)
+    assert summary['requests']['GET programs']['count'] == 2
+    assert summary['requests']['GET programs']['latency']['p50'] == 2
+    assert summary['total'] == {'count': 2, 'sent': 0, 'received': 1000}
+    assert summary['network_seconds'] == 3
+    assert summary['phases']['fetch'] == {'count': 1, 'seconds': 5, 'network_seconds': 3}
+    assert summary['phases']['validate']['network_seconds'] == 0
+    json.dumps(summary)
+
+
+def test_phase_and_trace(tmpdir):
+    metrics = Metrics()
+    with metrics.phase('load_csv'):
+        pass
+    metrics.write(RecordedApi({}, {}), str(tmpdir.join('metrics.json')), str(tmpdir.join('trace.json')))
+    with open(str(tmpdir.join('trace.json'))) as f:
+        events = json.load(f)['traceEvents']
+    assert [(e['name'], e['cat'], e['ph']) for e in events] == [('load_csv', 'phase', 'X')]
+    with open(str(tmpdir.join('metrics.json'))) as f:
+        assert json.load(f)['phases']['load_csv']['count'] == 1
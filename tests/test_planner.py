@@ -0,0 +1,39 @@
+from collections import defaultdict
+
+from src.planner import Plan, format_bytes, format_seconds
+
+
+class RecordedApi(object):
+
+    def __init__(self, timings=None, transferred=None):
+        self.timings = defaultdict(list, timings or {})
+        self.transferred = defaultdict(lambda: [0, 0], transferred or {})
+
+
+def test_format():
+    assert format_bytes(512) == u"512 B"
+    assert format_bytes(1536) == u"1.5 KB"
+    assert format_seconds(3725) == u"1h 02m 05s"
+
+
+def test_plan_latency_from_recorded_requests():
+    api = RecordedApi({'GET programs': [0.2, 0.4]}, {'GET programs': [100, 2000]})
+    plan = Plan(api, workers=4)
+    plan.add(u"update", 'PUT', 'organisationUnits', 8, upload=800, concurrent=True)
+    assert abs(plan.latency - 0.3) < 1e-9
+    rows = list(plan.rows())
+    assert rows[0] == (u"done while planning", 'GET', 'programs', 2, 100, 2000, False)
+    assert rows[1] == (u"update", 'PUT', 'organisationUnits', 8, 800, 0, True)
+
+
+def test_plan_default_latency():
+    plan = Plan(RecordedApi(), workers=0)
+    assert plan.workers == 1
+    assert plan.latency == 0.5
+
+
+def test_plan_report_notes(capsys):
+    plan = Plan(RecordedApi())
+    plan.note(u"-x is not estimated")
+    plan.report()
+    assert u"-x is not estimated" in capsys.readouterr().out.splitlines()[-1]
@@ -1,4 +1,5 @@
 import pytest
+import time
 import os
 
 from six import itervalues
@@ -180,3 +181,93 @@ def test_set_program_orgunits_append_existing(program_orgunit_map2, program_meta
     program_metadata.pop('organisationUnits')
     pairs = zip(updated_metadata, program_metadata)
     assert any(x != y for x, y in pairs)
+
+
+def test_set_program_orgunits_keeps_order(program_orgunit_map2, program_metadata):
+    updated_metadata = set_program_orgunits(program_metadata, program_orgunit_map2['VBqh0ynB2wv'], True)
+    assert [ou['id'] for ou in updated_metadata['organisationUnits']] == \
+        ['Nxw94OjsCjS', 'HlDMbDWUmTy', 'cDw53Ej8rju', 'bVZTNrnfn9G']
+    # original program is not modified
+    assert [ou['id'] for ou in program_metadata['organisationUnits']] == ['bVZTNrnfn9G', 'Nxw94OjsCjS']
+
+
+def test_benchmark_set_program_orgunits(program_metadata):
+    """100k assigned orgunits x 50k new orgunits (25k of them already assigned)"""
+    program_metadata['organisationUnits'] = [{'id': 'a{:010d}'.format(i)} for i in range(100000)]
+    new_orgunits = ['a{:010d}'.format(i) for i in range(75000, 125000)]
+    start = time.time()
+    updated_metadata = set_program_orgunits(program_metadata, new_orgunits, True)
+    elapsed = time.time() - start
+    print(u"\nset_program_orgunits: 100k x 50k in {:.3f}s".format(elapsed))
+    assert len(updated_metadata['organisationUnits']) == 125000
+    assert elapsed < 5
+
+
+def test_diff_program_orgunits():
+    current = ['bVZTNrnfn9G', 'Nxw94OjsCjS']
+    orgunit_list = ['HlDMbDWUmTy', 'bVZTNrnfn9G']
+    assert diff_program_orgunits(current, orgunit_list, True) == (['HlDMbDWUmTy'], [])
+    assert diff_program_orgunits(current, orgunit_list, False) == (['HlDMbDWUmTy'], ['Nxw94OjsCjS'])
+
+
+def test_fetch_and_import_programs_in_chunks():
+    from benchmarks.fake_dhis2 import FakeDhis2
+    from src.client import Client
+    with FakeDhis2(programs=5, orgunits=4, users=0, events=0) as server:
+        api = Client(server.url, 'admin', 'district')
+        program_orgunit_map = {'P0000000000': ['O0000000000'], 'P0000000003': ['O0000000001', 'O0000000002'],
+                               'P0000000004': ['O0000000003'], 'Pmissing000': ['O0000000000']}
+        programs = fetch_programs(api, program_orgunit_map)
+        assert sorted(p['id'] for p in programs) == ['P0000000000', 'P0000000003', 'P0000000004']
+        assert len(api.timings['GET programs']) == 1
+
+        payload = [set_program_orgunits(p, program_orgunit_map[p['id']], False) for p in programs]
+        assert import_programs(api, payload, chunk_size=2) == {}
+        assert len(api.timings['POST metadata']) == 2
+        assert server.index[('programs', 'P0000000003')]['organisationUnits'] == [
+            {'id': 'O0000000001'}, {'id': 'O0000000002'}]
+
+
+def test_import_programs_failed_chunk(monkeypatch):
+    import src.program_orgunit_assigner as assigner
+    reports = iter([{'status': 'OK', 'typeReports': []}, {'status': 'ERROR', 'typeReports': []}])
+    monkeypatch.setattr(assigner, 'post_metadata', lambda api, data, params: next(reports))
+    programs = [{'id': 'P{:010d}'.format(i)} for i in range(3)]
+    assert import_programs(None, programs, chunk_size=2) == {'P0000000002': [u"Import of chunk failed"]}
+
+
+@pytest.mark.parametrize('chunk_size', ['0', '-1'])
+def test_chunk_size_below_one_rejected(chunk_size, monkeypatch):
+    monkeypatch.setattr('sys.argv', ['hnqis-program-orgunit', '-c', 'file.csv', '--chunk', chunk_size])
+    with pytest.raises(SystemExit):
+        parse_args()
+
+
+def test_assign_delta_backup_and_failed_program(tmpdir, monkeypatch):
+    from benchmarks.fake_dhis2 import FakeDhis2
+    from src.backup import BACKUP_DIR, load_manifest, read_backup
+    from src.client import Client
+    monkeypatch.chdir(str(tmpdir))
+    with FakeDhis2(programs=3, orgunits=3, users=0, events=0) as server:
+        server.index[('programs', 'P0000000002')]['organisationUnits'] = [{'id': 'O0000000002'}]
+        handle = server.handle
+
+        def failing_handle(method, path, params, body):
+            if method == 'POST' and path == 'programs/P0000000001/organisationUnits':
+                return 500, {'httpStatusCode': 500}
+            return handle(method, path, params, body)
+
+        server.handle = failing_handle
+        api = Client(server.url, 'admin', 'district')
+        program_orgunit_map = {uid: ['O0000000000', 'O0000000001'] for uid in
+                               ('P0000000000', 'P0000000001', 'P0000000002')}
+        assign_delta(api, program_orgunit_map, False, False)
+
+        # the program after the failed one is still updated
+        assert server.index[('programs', 'P0000000002')]['organisationUnits'] == [
+            {'id': 'O0000000000'}, {'id': 'O0000000001'}]
+        assert server.index[('programs', 'P0000000001')]['organisationUnits'] == []
+        backup = read_backup(os.path.join(BACKUP_DIR, load_manifest(BACKUP_DIR)[-1]['file']))
+        before = {p['id']: p['organisationUnits'] for p in backup['programs']}
+        assert before['P0000000002'] == [{'id': 'O0000000002'}]
+        assert all('shortName' in p for p in backup['programs'])
@@ -0,0 +1,328 @@
+import os
+import time
+
+import pytest
+
+from src.journal import Journal, load_journal
+from src.scan_event_mismatches import *
+
+ROOT_COMPSCORE = 'Ex8EkRmuOJX'
+
+
+def make_grid(events, params):
+    """/api/events/query grid of events with a column per requested data element"""
+    data_elements = params['dataElement'].split(',')
+    rows = []
+    for event in events:
+        values = {dv['dataElement']: dv['value'] for dv in event['dataValues']}
+        rows.append([event.get(name, '') for name in EVENT_COLUMNS] + [values.get(de, '') for de in data_elements])
+    return {'headers': [{'name': name} for name in list(EVENT_COLUMNS) + data_elements], 'rows': rows}
+
+
+class GridApi(object):
+    """Serves pre-defined event pages via /api/events/query"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.params = None
+        self.requests = 0
+
+    def get(self, endpoint, params=None):
+        self.params = dict(params)
+        self.requests += 1
+        page = self.pages[params['page'] - 1] if params['page'] <= len(self.pages) else []
+        return Response(make_grid(page, params))
+
+
+@pytest.fixture
+def program():
+    return {'id': 'VBqh0ynB2wv', 'name': 'HNQIS - FP'}
+
+
+def make_event(uid, overall_score, compscore):
+    return {
+        'event': uid,
+        'eventDate': '2018-05-01T00:00:00.000',
+        'dataValues': [
+            {'dataElement': OVERALL_SCORE, 'value': str(overall_score)},
+            {'dataElement': ROOT_COMPSCORE, 'value': str(compscore)},
+            {'dataElement': 'hvitKDL9qRH', 'value': 'unrelated'}
+        ]
+    }
+
+
+def test_iter_pages_requests_only_wanted_datavalues():
+    api = GridApi([[make_event('GiLuEVJINLv', 80, 80)], [make_event('HlDMbDWUmTy', 80, 70)]])
+    wanted = {OVERALL_SCORE, ORDER_FORWARD, ROOT_COMPSCORE}
+    events = [e for page in iter_pages(api, 'VBqh0ynB2wv', wanted, page_size=1) for e in page]
+    assert [e['event'] for e in events] == ['GiLuEVJINLv', 'HlDMbDWUmTy']
+    assert set(api.params['dataElement'].split(',')) == wanted
+    assert events[1]['dataValues'] == sorted([{'dataElement': OVERALL_SCORE, 'value': '80'},
+                                              {'dataElement': ROOT_COMPSCORE, 'value': '70'}],
+                                             key=lambda dv: dv['dataElement'])
+    # the last page is the first one shorter than page_size
+    assert api.requests == 3
+
+
+def test_grid_events_dates():
+    grid = {'headers': [{'name': 'event'}, {'name': 'eventDate'}, {'name': OVERALL_SCORE}],
+            'rows': [['GiLuEVJINLv', '2018-05-01 00:00:00.0', '']]}
+    assert grid_events(grid, [OVERALL_SCORE]) == [
+        {'event': 'GiLuEVJINLv', 'eventDate': '2018-05-01T00:00:00.0', 'dataValues': []}]
+
+
+def test_scan_program_sorted(program):
+    e1 = make_event('HlDMbDWUmTy', 80, 70)
+    e2 = make_event('GiLuEVJINLv', 80, 60)
+    e3 = make_event('cDw53Ej8rju', 80, 80)
+    e1['eventDate'] = '2018-06-01T00:00:00.000'
+    api = GridApi([[e1, e2], [e3]])
+    wanted = {OVERALL_SCORE, ORDER_FORWARD, ROOT_COMPSCORE}
+    rows, changed, watermark = scan_program(api, program, [ROOT_COMPSCORE], wanted, page_size=2)
+    assert [r[3] for r in rows] == ['GiLuEVJINLv', 'HlDMbDWUmTy']
+    assert rows[0][4:] == (80.0, 60.0, 20.0)
+    assert changed is None
+
+
+def test_scan_program_incremental(program):
+    e1 = make_event('HlDMbDWUmTy', 80, 70)
+    e2 = make_event('GiLuEVJINLv', 80, 80)
+    e1['lastUpdated'] = '2018-07-01T10:00:00.000'
+    e2['lastUpdated'] = '2018-07-02T10:00:00.000'
+    api = GridApi([[e1, e2]])
+    wanted = {OVERALL_SCORE, ORDER_FORWARD, ROOT_COMPSCORE}
+    rows, changed, watermark = scan_program(api, program, [ROOT_COMPSCORE], wanted, since='2018-06-30T00:00:00.000')
+    assert api.params['lastUpdatedStartDate'] == '2018-06-30T00:00:00.000'
+    assert changed == {'HlDMbDWUmTy', 'GiLuEVJINLv'}
+    assert watermark == '2018-07-02T10:00:00.000'
+
+
+def test_merge_ledger():
+    ledger = {
+        'GiLuEVJINLv': ['2018-05-01', 'VBqh0ynB2wv', 'HNQIS - FP', 'GiLuEVJINLv', 80.0, 60.0, 20.0],
+        'cDw53Ej8rju': ['2018-05-01', 'lxAQ7Zs9VYR', 'HNQIS - TB', 'cDw53Ej8rju', 80.0, 60.0, 20.0]
+    }
+    new_row = ('2018-07-01', 'VBqh0ynB2wv', 'HNQIS - FP', 'HlDMbDWUmTy', 80.0, 70.0, 10.0)
+    # GiLuEVJINLv was rescanned and is no longer a mismatch
+    merge_ledger(ledger, 'VBqh0ynB2wv', [new_row], {'GiLuEVJINLv', 'HlDMbDWUmTy'})
+    assert set(ledger) == {'cDw53Ej8rju', 'HlDMbDWUmTy'}
+
+    # a full scan replaces every entry of the program
+    merge_ledger(ledger, 'lxAQ7Zs9VYR', [], None)
+    assert set(ledger) == {'HlDMbDWUmTy'}
+
+
+ENGINES = ['python'] + (['numpy'] if numpy is not None else [])
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_analyze_page(program, engine):
+    events = [make_event('HlDMbDWUmTy', 80, 70), make_event('GiLuEVJINLv', 80, 80.5),
+              make_event('cDw53Ej8rju', 55.5, 90), {'event': 'Rp268JB6Ne4', 'eventDate': '2018-05-01', 'dataValues': []}]
+    # a difference of up to THRESHOLD is not a mismatch, events without scores are skipped
+    assert analyze_page(program, events, [ROOT_COMPSCORE], engine) == [
+        ('2018-05-01T00:00:00.000', 'VBqh0ynB2wv', 'HNQIS - FP', 'HlDMbDWUmTy', 80.0, 70.0, 10.0),
+        ('2018-05-01T00:00:00.000', 'VBqh0ynB2wv', 'HNQIS - FP', 'cDw53Ej8rju', 55.5, 90.0, 34.5)
+    ]
+
+
+def synthetic_pages(page_count, page_size=1000):
+    """Cycle through a few synthetic pages with ~10% mismatches to keep memory flat"""
+    pages = []
+    for p in range(10):
+        page = []
+        for i in range(page_size):
+            score = 80 if (p * page_size + i) % 10 else 60
+            page.append(make_event('a{:010d}'.format(p * page_size + i), 80, score))
+        pages.append(page)
+    for n in range(page_count):
+        yield pages[n % len(pages)]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_benchmark_analyze_page(program, engine):
+    """Prints events/second, run with e.g. HNQIS_BENCH_EVENTS=1000000 python -m pytest -s -k benchmark"""
+    total = int(os.environ.get('HNQIS_BENCH_EVENTS', 20000))
+    root_compscores = frozenset([ROOT_COMPSCORE] + ['a{:010d}'.format(i) for i in range(200)])
+    mismatches = 0
+    start = time.time()
+    for page in synthetic_pages(total // 1000):
+        mismatches += len(analyze_page(program, page, root_compscores, engine))
+    elapsed = time.time() - start
+    assert mismatches == total // 10
+    print(u"\n{}: {} events in {:.2f}s ({:.0f} events/s)".format(engine, total, elapsed, total / max(elapsed, 1e-9)))
+
+
+def test_failed_import_references():
+    summaries = {
+        "httpStatus": "Conflict",
+        "response": {
+            "responseType": "ImportSummaries",
+            "status": "ERROR",
+            "importSummaries": [
+                {"status": "SUCCESS", "reference": "HlDMbDWUmTy"},
+                {"status": "ERROR", "reference": "GiLuEVJINLv", "conflicts": [{"value": "Event.orgUnit does not point to a valid organisation unit"}]},
+                {"status": "ERROR"},
+                {"status": "WARNING", "reference": "Rp268JB6Ne4"}
+            ]
+        }
+    }
+    events = [{'event': 'HlDMbDWUmTy'}, {'event': 'GiLuEVJINLv'}, {'event': 'cDw53Ej8rju'}, {'event': 'Rp268JB6Ne4'}]
+    assert failed_import_references(summaries, events) == ['GiLuEVJINLv', 'cDw53Ej8rju']
+
+
+def test_minimal_event():
+    event = make_event('HlDMbDWUmTy', 80, 70)
+    event.update({'program': 'VBqh0ynB2wv', 'orgUnit': 'DiszpKrYNg8', 'status': 'COMPLETED', 'storedBy': 'admin'})
+    event['dataValues'].append({'dataElement': ORDER_FORWARD, 'value': '3'})
+    fixed = minimal_event(fix_event(event, [ROOT_COMPSCORE]))
+    assert 'storedBy' not in fixed
+    assert fixed['orgUnit'] == 'DiszpKrYNg8'
+    assert {dv['dataElement']: dv['value'] for dv in fixed['dataValues']} == {OVERALL_SCORE: '70', ORDER_FORWARD: '9999'}
+
+
+class FixApi(object):
+    """Serves events by UID and accepts every import"""
+
+    version_int = 32
+
+    def __init__(self, events):
+        self.events = {e['event']: e for e in events}
+        self.imported = []
+
+    def get(self, endpoint, params=None):
+        return Response(make_grid([self.events[uid] for uid in params['event'].split(';')], params))
+
+    def post(self, endpoint, params=None, data=None):
+        self.imported.extend(e['event'] for e in data['events'])
+        return Response({'status': 'OK', 'importSummaries': []})
+
+
+class Response(object):
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+def test_fix_events_resume(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    api = FixApi([make_event('Nxw94OjsCjS', 70, 80), make_event('bVZTNrnfn9G', 60, 90)])
+    with Journal(path) as journal:
+        journal.record(('Nxw94OjsCjS',))
+        fix_events(api, ['Nxw94OjsCjS', 'bVZTNrnfn9G'], [ROOT_COMPSCORE], batch_size=1, journal=journal)
+    assert api.imported == ['bVZTNrnfn9G']
+    assert load_journal(path) == {('Nxw94OjsCjS',), ('bVZTNrnfn9G',)}
+
+
+class FailingImportApi(FixApi):
+    """Answers the bulk import with ERROR summaries that can't be matched to a posted event"""
+
+    def __init__(self, events, summaries):
+        super(FailingImportApi, self).__init__(events)
+        self.summaries = summaries
+
+    def post(self, endpoint, params=None, data=None):
+        super(FailingImportApi, self).post(endpoint, params, data)
+        return Response({'status': 'ERROR', 'importSummaries': self.summaries})
+
+
+@pytest.mark.parametrize('summary', [{'status': 'ERROR'}, {'status': 'ERROR', 'reference': 'cDw53Ej8rju'}])
+def test_fix_events_unknown_failed_reference(tmpdir, summary):
+    path = str(tmpdir.join('journal.jsonl'))
+    api = FailingImportApi([make_event('Nxw94OjsCjS', 70, 80)],
+                           [{'status': 'SUCCESS', 'reference': 'Nxw94OjsCjS'}, summary])
+    with Journal(path) as journal:
+        fix_events(api, ['Nxw94OjsCjS'], [ROOT_COMPSCORE], batch_size=1, journal=journal)
+    assert api.imported == ['Nxw94OjsCjS']
+    # the failed event is not known, so the batch is fixed again on --resume
+    assert load_journal(path) == set()
+
+
+class PlanApi(object):
+    """Answers the one-event page plan_run requests per program"""
+
+    version_int = 32
+
+    def __init__(self, total):
+        self.total = total
+
+    def get(self, endpoint, params=None):
+        grid = make_grid([make_event('Nxw94OjsCjS', 70, 80)], params)
+        grid['metaData'] = {'pager': {'total': self.total}}
+        return Response(grid)
+
+
+class PlanArgs(object):
+    parallel = 1
+    page_size = 100
+    batch_size = 50
+    fix_values = True
+
+
+def test_plan_run_fix(program):
+    mismatches = ['e{:010d}'.format(i) for i in range(120)]
+    wanted = {OVERALL_SCORE, ORDER_FORWARD, ROOT_COMPSCORE}
+    plan = plan_run(PlanApi(1000), PlanArgs(), [program], wanted, lambda p: None, mismatches)
+    grid = make_grid([make_event('Nxw94OjsCjS', 70, 80)], {'dataElement': ','.join(sorted(wanted))})
+    size = len(json.dumps(grid['rows'][0]))
+    assert [step[:5] for step in plan.steps] == [
+        (program['name'], 'GET', 'events/query', 10, 0),
+        (u"-x: fetch 120 mismatched events", 'GET', 'events/query', 3, 0),
+        (u"-x: import fixed events", 'POST', 'events', 3, 120 * size)
+    ]
+    assert plan.notes == []
+
+
+def test_plan_run_fix_without_state(program):
+    plan = plan_run(PlanApi(1000), PlanArgs(), [program], {OVERALL_SCORE, ROOT_COMPSCORE}, lambda p: None)
+    assert [step[1] for step in plan.steps] == ['GET']
+    assert len(plan.notes) == 1
+
+
+class UnknownVersionApi(FixApi):
+    """A server whose version string dhis2.utils.version_to_int can't parse"""
+
+    version_int = None
+
+    def __init__(self, events):
+        super(UnknownVersionApi, self).__init__(events)
+        self.put_endpoints = []
+
+    def put(self, endpoint, params=None, data=None):
+        self.put_endpoints.append(endpoint)
+
+
+def test_fix_events_unknown_version():
+    api = UnknownVersionApi([make_event('Nxw94OjsCjS', 70, 80)])
+    fix_events(api, ['Nxw94OjsCjS'], [ROOT_COMPSCORE])
+    # no bulk import - every data value is PUT on its own
+    assert api.imported == []
+    assert api.put_endpoints == ['events/Nxw94OjsCjS/{}'.format(OVERALL_SCORE)]
+
+
+@pytest.mark.parametrize('argument', ['-b=0', '-b=-5', '-n=0', '--parallel=0'])
+def test_sizes_below_one_rejected(argument, monkeypatch):
+    monkeypatch.setattr('sys.argv', ['hnqis-scan-mismatches', argument])
+    with pytest.raises(SystemExit):
+        parse_args()
+
+
+def test_save_state_interrupted(tmpdir, monkeypatch):
+    path = str(tmpdir.join('state.json'))
+    state = {'programs': {'VBqh0ynB2wv': '2018-07-02T10:00:00.000'}, 'mismatches': {}}
+    save_state(path, state)
+    assert load_state(path) == state
+
+    def dump(obj, f):
+        f.write('{"programs": ')
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr('src.scan_event_mismatches.json.dump', dump)
+    with pytest.raises(KeyboardInterrupt):
+        save_state(path, {'programs': {}, 'mismatches': {}})
+    monkeypatch.undo()
+    assert load_state(path) == state
+    assert os.listdir(str(tmpdir)) == ['state.json']
@@ -0,0 +1,41 @@
+import pytest
+
+from src.user_message import *
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class UsersApi(object):
+    """Answers `username:in` filters on users from a fixed list of users"""
+
+    def __init__(self, users):
+        self.users = users
+        self.requests = []
+
+    def get(self, endpoint, params=None):
+        self.requests.append(params)
+        usernames = params['filter'].split(':in:[', 1)[1].rstrip(']').split(',')
+        return FakeResponse({'users': [u for u in self.users if get_username(u) in usernames]})
+
+
+@pytest.fixture
+def users():
+    return [
+        {'id': 'DXyJmlo9rge', 'userCredentials': {'username': 'android'}, 'attributeValues': []},
+        {'id': 'xE7jOejl9FI', 'userCredentials': {'username': 'admin'}, 'attributeValues': []},
+        {'id': 'M0fCOxtkURr', 'username': 'system', 'attributeValues': []}
+    ]
+
+
+def test_index_users(users):
+    api = UsersApi(users)
+    index = index_users(api, ['android', 'admin', 'system', 'unknown'], chunk_size=2)
+    assert len(api.requests) == 2
+    assert set(index) == {'android', 'admin', 'system'}
+    assert index['admin']['id'] == 'xE7jOejl9FI'
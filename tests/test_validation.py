@@ -0,0 +1,47 @@
+import os
+
+import pytest
+from dhis2 import load_csv
+
+from src.validation import *
+
+
+def test_validate_rows_collects_all_errors():
+    rows = [
+        {'key': 'hvitKDL9qRH', 'value': '1'},
+        {'key': 'abc', 'value': '2'},
+        {'key': 'hvitKDL9qRH', 'value': ''},
+        {'key': 'rxFEOPYJVxL', 'value': '4'},
+    ]
+    errors = validate_rows(iter(rows), required=['key', 'value'], key='key')
+    assert errors == [
+        (3, 'key', 'abc', u"abc is not a valid UID"),
+        (4, 'value', '', u"Empty value"),
+        (4, 'key', 'hvitKDL9qRH', u"Duplicate hvitKDL9qRH"),
+    ]
+
+
+def test_validate_rows_headers():
+    errors = validate_rows([{'orgunit': 'GiLuEVJINLv', 'abc': 'yes'}], required=['orgunit'], key='orgunit',
+                           uid_headers=True)
+    assert errors == [(1, 'abc', 'abc', u"abc is not a valid UID")]
+
+    errors = validate_rows([{'username': 'admin'}], required=['username', 'message'], key='username',
+                           key_is_uid=False)
+    assert errors == [(1, 'message', '', u"CSV must have 'message' header")]
+
+    assert validate_rows([], required=['orgunit'], key='orgunit')[0][3] == u"CSV not valid (empty?)"
+
+
+def test_check_writes_report(tmpdir):
+    report = str(tmpdir.join('file_errors.csv'))
+    errors = [(3, 'key', 'abc', u"abc is not a valid UID")]
+    with pytest.raises(ValueError):
+        check(errors, report)
+    rows = list(load_csv(report))
+    assert rows == [{'line': '3', 'column': 'key', 'value': 'abc', 'error': 'abc is not a valid UID'}]
+    assert check([], report)
+
+
+def test_report_filename():
+    assert report_filename(os.path.join('path', 'file.csv')) == os.path.join('path', 'file_errors.csv')